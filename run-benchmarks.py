@@ -0,0 +1,380 @@
+# coding: utf-8
+
+""" Micro-benchmarks for tinysync.
+
+Run all benchmarks with:
+
+    python run-benchmarks.py
+
+Or give the names of specific benchmarks as arguments.
+"""
+
+import sys, os, time, copy, threading, tempfile, tracemalloc
+from functools import partial
+from operator import setitem
+
+from tinysync import track, subscribe, snapshot, handler
+from tinysync import SafeYamlFile, JournalFile, flush
+from tinysync import JsonFile, MsgpackFile, PickleFile, JsonDBM
+
+
+benchmarks = {}
+
+def benchmark(func):
+    benchmarks[func.__name__] = func
+    return func
+
+def per_op(func, count):
+    """ Returns the average time in microseconds of
+    calling `func` with values `range(count)`. """
+    start = time.perf_counter()
+    for i in range(count):
+        func(i)
+    return (time.perf_counter() - start) / count * 1e6
+
+
+@benchmark
+def append_and_setitem(sizes=(1000, 10000, 100000), count=1000):
+    """ Cost of a single append or item assignment should stay flat
+    as the tracked container grows. """
+    print('%10s %14s %14s %14s' % (
+        'size', 'list append', 'list setitem', 'dict setitem'))
+    for size in sizes:
+        tracked_list = track(list(range(size)))
+        tracked_dict = track(dict.fromkeys(range(size), 0))
+        append = per_op(lambda i: tracked_list.append({'i': i}), count)
+        list_setitem = per_op(
+            lambda i: setitem(tracked_list, i, [i]), count)
+        dict_setitem = per_op(
+            lambda i: setitem(tracked_dict, i, {'i': i}), count)
+        print('%10d %12.1fus %12.1fus %12.1fus' % (
+            size, append, list_setitem, dict_setitem))
+
+
+@benchmark
+def list_insert_front(sizes=(1000, 10000, 100000), count=1000):
+    """ Inserting to or popping from the front of a list of tracked
+    dicts should not update the paths of the following values. """
+    print('%10s %14s %14s' % ('size', 'insert(0)', 'pop(0)'))
+    for size in sizes:
+        tracked_list = track([{'i': i} for i in range(size)])
+        insert = per_op(lambda i: tracked_list.insert(0, {'i': i}), count)
+        pop = per_op(lambda i: tracked_list.pop(0), count)
+        print('%10d %12.1fus %12.1fus' % (size, insert, pop))
+
+
+@benchmark
+def wrap_tree(items=125000):
+    """ Time to track a tree of about 1M nodes,
+    dominated by type checks of the contained values. """
+    tree = [
+        {'id': i, 'name': 'item', 'tags': ['a', 'b'], 'size': 1.0}
+        for i in range(items)
+    ]
+    nodes = items * 8 + 1
+    start = time.perf_counter()
+    track(tree)
+    elapsed = time.perf_counter() - start
+    print('%d nodes tracked in %.2fs (%.2fus per node)' % (
+        nodes, elapsed, elapsed / nodes * 1e6))
+
+@benchmark
+def read_overhead(count=200000):
+    """ Cost of common reads on tracked containers
+    compared to the plain containers. """
+    plain = {'a': {'b': [1, 2, 3]}}
+    tracked = track(copy.deepcopy(plain))
+    tracked_dot = track(copy.deepcopy(plain), dot_access=True)
+    reads = {
+        "d['a']['b']": lambda d, i: d['a']['b'],
+        "d['a']['b'][1]": lambda d, i: d['a']['b'][1],
+        "len(d['a'])": lambda d, i: len(d['a']),
+        "'b' in d['a']": lambda d, i: 'b' in d['a'],
+        "for x in d['a']['b']": lambda d, i: [x for x in d['a']['b']],
+    }
+    print('%22s %10s %10s %10s %7s' % (
+        'read', 'plain', 'tracked', 'dot', 'ratio'))
+    for name, read in reads.items():
+        times = [
+            per_op(partial(read, data), count)
+            for data in (plain, tracked, tracked_dot)
+        ]
+        print('%22s %8.3fus %8.3fus %8.3fus %6.1fx' % (
+            name, *times, times[1] / times[0]))
+
+@benchmark
+def read_contention(readers=(1, 4, 16), duration=1.0):
+    """ Reads per second from N reader threads while one writer
+    thread keeps making changes, with the default lock and with
+    the shared read-write lock. """
+    print('%8s %12s %14s %14s' % (
+        'readers', 'lock', 'reads/s', 'writes/s'))
+    for count in readers:
+        for read_write_lock in (False, True):
+            tracked = track(
+                {'a': {'b': list(range(10))}},
+                read_write_lock=read_write_lock)
+            done = threading.Event()
+            reads = [0] * count
+            writes = 0
+            def reader(index):
+                values = tracked['a']['b']
+                while not done.is_set():
+                    for i in range(100):
+                        values[i % 10]
+                        len(values)
+                    reads[index] += 200
+            def writer():
+                nonlocal writes
+                while not done.is_set():
+                    with tracked:
+                        tracked['a']['b'][writes % 10] = writes
+                    writes += 1
+                    time.sleep(0.0001)
+            threads = [
+                threading.Thread(target=reader, args=(i,))
+                for i in range(count)
+            ] + [threading.Thread(target=writer)]
+            for thread in threads:
+                thread.start()
+            time.sleep(duration)
+            done.set()
+            for thread in threads:
+                thread.join()
+            print('%8d %12s %14d %14d' % (
+                count, 'read-write' if read_write_lock else 'default',
+                sum(reads) / duration, writes / duration))
+
+@benchmark
+def subscribers(count=10000, changes=1000):
+    """ Cost of a change with a listener for each of `count`
+    subtrees, as path-prefix subscriptions compared to one
+    change callback that checks the path for every listener. """
+    calls = [0]
+    def listener(data):
+        calls[0] += 1
+    listeners = [(['panel%d' % i], listener) for i in range(count)]
+    def change_callback(data):
+        for prefix, callback in listeners:
+            if data.path[:len(prefix)] == prefix:
+                callback(data)
+    data = {'panel%d' % i: {'value': 0} for i in range(count)}
+    callback_tracked = track(
+        copy.deepcopy(data), change_callback=change_callback)
+    subscribed = track(copy.deepcopy(data))
+    for prefix, callback in listeners:
+        subscribe(subscribed, prefix, callback)
+    print('%14s %14s' % ('callback', 'subscriptions'))
+    times = [
+        per_op(lambda i: setitem(
+            tracked['panel%d' % (i % count)], 'value', i), changes)
+        for tracked in (callback_tracked, subscribed)
+    ]
+    print('%12.1fus %12.1fus' % tuple(times))
+    assert calls[0] == 2 * changes
+
+@benchmark
+def bulk_load(count=200):
+    """ Loading records into a tracked list persisted as YAML,
+    one append at a time compared to one bulk_extend. """
+    records = [{'id': i, 'tags': ['a', 'b']} for i in range(count)]
+    with tempfile.TemporaryDirectory() as directory:
+        name = os.path.join(directory, 'bulk')
+        tracked = track({'records': []}, name)
+        start = time.perf_counter()
+        for record in copy.deepcopy(records):
+            tracked['records'].append(record)
+        appends = time.perf_counter() - start
+        tracked = track({'records': []}, name + '-bulk')
+        start = time.perf_counter()
+        tracked['records'].bulk_extend(copy.deepcopy(records))
+        bulk = time.perf_counter() - start
+    print('%d records: %.2fs with append, %.3fs with bulk_extend' % (
+        count, appends, bulk))
+
+@benchmark
+def snapshots(items=10000):
+    """ Snapshots of a tracked tree share the unchanged containers,
+    so after the first one only the changed containers are copied. """
+    tracked = track({
+        'items': [{'id': i, 'tags': ['a', 'b']} for i in range(items)]})
+    def timed(func):
+        start = time.perf_counter()
+        func()
+        return (time.perf_counter() - start) * 1000
+    print('%20s %10.2fms' % ('deepcopy', timed(lambda: copy.deepcopy(tracked))))
+    print('%20s %10.2fms' % ('first snapshot', timed(lambda: snapshot(tracked))))
+    print('%20s %10.2fms' % ('no changes', timed(lambda: snapshot(tracked))))
+    tracked['items'][items // 2]['tags'].append('c')
+    print('%20s %10.2fms' % ('one change', timed(lambda: snapshot(tracked))))
+
+@benchmark
+def history_goto(entries=10000, checkpoint_every=100):
+    """ Jumping back to the oldest version, one entry at a time
+    compared to restoring the closest checkpoint first. """
+    print('%18s %10s' % ('checkpoint_every', 'goto'))
+    for every in (0, checkpoint_every):
+        tracked = track({'items': [{'i': i} for i in range(1000)]}, history=True)
+        history = handler(tracked).history
+        history.checkpoint_every = every
+        for i in range(entries):
+            tracked['items'][i % 1000]['i'] = -i
+        start = time.perf_counter()
+        history.goto(2)
+        print('%18d %8.1fms' % (every, (time.perf_counter() - start) * 1000))
+
+@benchmark
+def tracker_memory(items=100000):
+    """ Memory allocated by tracking, per tracked container,
+    measured with tracemalloc. """
+    tree = [{'i': i} for i in range(items)]
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    tracked = track(tree)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print('%d containers, %.1f bytes per tracked container' % (
+        items + 1, (after - before) / (items + 1)))
+
+@benchmark
+def deep_paths(depths=(5, 20, 50), count=20000):
+    """ Resolving the same deep paths again, with the paths cached
+    compared to walking from the root every time. """
+    print('%10s %14s %14s' % ('depth', 'cached', 'uncached'))
+    for depth in depths:
+        tree = leaf = {}
+        path = []
+        for level in range(depth):
+            leaf['next'] = [{}, {}] if level % 2 else {}
+            path.append('next')
+            leaf = leaf['next']
+            if level % 2:
+                path.append(1)
+                leaf = leaf[1]
+        leaf['value'] = 1
+        path.append('value')
+        tracked = track(tree)
+        tracked_handler = handler(tracked)
+        at = tracked_handler.at
+        cached = per_op(lambda i: at(path), count)
+        def uncached(i):
+            tracked_handler.path_cache.clear()
+            at(path)
+        print('%10d %12.1fus %12.1fus' % (
+            depth, cached, per_op(uncached, count)))
+
+@benchmark
+def journal_writes(sizes=(1000, 10000), count=20):
+    """ Cost of persisting a single change to a structure of the
+    given size, rewriting the whole file compared to appending
+    the change to a journal. """
+    print('%10s %14s %14s' % ('size', 'yaml file', 'journal'))
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            results = []
+            for persistence in (SafeYamlFile, JournalFile):
+                name = os.path.join(
+                    directory, '%s%d' % (persistence.__name__, size))
+                tracked = track(
+                    {'items': [{'i': i, 'tags': ['a', 'b']}
+                        for i in range(size)]},
+                    name, persist=persistence(name))
+                items = tracked['items']
+                results.append(per_op(
+                    lambda i: setitem(items[i], 'i', -i), count))
+            print('%10d %12.1fus %12.1fus' % (size, *results))
+
+@benchmark
+def write_behind(size=1000, count=200):
+    """ Latency of a change saved to a YAML file, saving in the
+    thread making the change compared to a write-behind thread,
+    and the number of times the file was written. """
+    print('%14s %14s %10s %14s' % ('mode', 'per change', 'dumps', 'total'))
+    with tempfile.TemporaryDirectory() as directory:
+        for mode in (False, True):
+            name = os.path.join(directory, 'write_behind%s' % mode)
+            persistence = SafeYamlFile(name)
+            tracked = track(
+                {'items': [{'i': i} for i in range(size)]},
+                name, persist=persistence, write_behind=mode)
+            dumps = []
+            original_dump = persistence.dump
+            def counting_dump(*args, **kwargs):
+                dumps.append(1)
+                return original_dump(*args, **kwargs)
+            persistence.dump = counting_dump
+            items = tracked['items']
+            start = time.perf_counter()
+            latency = per_op(lambda i: setitem(items[i], 'i', -i), count)
+            flush(tracked)
+            total = time.perf_counter() - start
+            print('%14s %12.1fus %10d %12.1fms' % (
+                'write-behind' if mode else 'synchronous',
+                latency, len(dumps), total * 1000))
+
+@benchmark
+def file_formats(sizes=(1000, 10000, 100000)):
+    """ Time to dump and load a structure of the given number of
+    records in the available file formats. """
+    def stdlib_json(name):
+        persistence = JsonFile(name)
+        persistence.orjson = None
+        persistence.file_format = 'stdlib.json'
+        return persistence
+    formats = [
+        ('yaml', SafeYamlFile), ('json', JsonFile),
+        ('json (stdlib)', stdlib_json), ('msgpack', MsgpackFile),
+        ('pickle', PickleFile),
+    ]
+    print('%14s %10s %12s %12s' % ('format', 'size', 'dump', 'load'))
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            tree = {'items': [
+                {'i': i, 'name': 'item %d' % i, 'tags': ['a', 'b']}
+                for i in range(size)]}
+            for label, persistence_class in formats:
+                try:
+                    persistence = persistence_class(
+                        os.path.join(directory, 'formats%d' % size))
+                except ImportError:
+                    print('%14s %10d %12s' % (label, size, 'n/a'))
+                    continue
+                start = time.perf_counter()
+                persistence.dump(tree)
+                dumped = time.perf_counter()
+                persistence.load()
+                loaded = time.perf_counter()
+                print('%14s %10d %10.1fms %10.1fms' % (
+                    label, size, (dumped - start) * 1000,
+                    (loaded - dumped) * 1000))
+
+@benchmark
+def dbm_shards(customers=10, orders=2000, count=50):
+    """ Cost of saving a one-field change deep in a large
+    per-customer document, with the documents split into
+    shards at different depths. """
+    print('%10s %10s %14s' % ('depth', 'shards', 'per change'))
+    with tempfile.TemporaryDirectory() as directory:
+        for depth in (1, 2, 3):
+            name = os.path.join(directory, 'shards%d' % depth)
+            persistence = JsonDBM(name, depth=depth)
+            tracked = track({
+                'customer%d' % c: {
+                    'profile': {'name': 'Customer %d' % c},
+                    'orders': {
+                        'order%d' % o: {'items': list(range(10)), 'paid': False}
+                        for o in range(orders)
+                    },
+                } for c in range(customers)
+            }, name, persist=persistence)
+            orders_of = tracked['customer0']['orders']
+            per_change = per_op(lambda i: setitem(
+                orders_of['order%d' % i], 'paid', True), count)
+            print('%10d %10d %12.1fus' % (
+                depth, len(persistence.stored), per_change))
+            persistence.db.close()
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or benchmarks:
+        print('\n' + name)
+        benchmarks[name]()
@@ -3,9 +3,16 @@
 import unittest
 import unittest.mock as mock
 from functools import partial
-import copy, time, threading
+import copy, time, threading, dataclasses, os, tempfile, json
+import gc, weakref
 
-from tinysync import track, istracked, atomic, NoNameNoPersistence, handler
+from tinysync import track, istracked, atomic, flush, snapshot, handler
+from tinysync import deepcopy_tracked, subscribe, unsubscribe
+from tinysync import NoNameNoPersistence, CompressedEntry, Handler
+from tinysync import trackable_types, FieldsWrapper, CustomWrapper
+from tinysync import JournalFile, Persistence
+from tinysync import SafeYamlFile, JsonFile, PickleFile, JsonDBM
+from tinysync import LazyLoadMarker
 from tinysync.sync import QueueControl, queued
 from tinysync.conduit.conduit import MemoryConduit
 
@@ -34,6 +41,38 @@ class TestBasics(unittest.TestCase):
         self.assertTrue(istracked(t))
         self.assertTrue(t.__subject__ == s)
         
+    def test_incremental_updates(self):
+        t = track([{'a': 1}])
+        t.append({'b': 2})
+        t.insert(0, [3])
+        t.extend([{'c': 4}])
+        t[1]['a'] = {'d': 5}
+        self.assertTrue(all(istracked(value) for value in t))
+        self.assertTrue(
+            [value._tracker.path for value in t] == [[0], [1], [2], [3]])
+        self.assertTrue(t[1]['a']._tracker.path == [1, 'a'])
+        t.pop(0)
+        self.assertTrue(t[0]['a']._tracker.path == [0, 'a'])
+        d = track({})
+        d.update({'a': []}, b={})
+        d.setdefault('c', set())
+        self.assertTrue(all(istracked(value) for value in d.values()))
+
+    def test_lazy(self):
+        d = {'a': {'b': [1, {'c': 2}]}, 'd': [[3]]}
+        t = track(d, lazy=True)
+        self.assertTrue(type(d['a']) == dict)
+        b = t['a']['b']
+        self.assertTrue(istracked(b))
+        self.assertTrue(istracked(d['a']))
+        self.assertTrue(type(d['d']) == list)
+        self.assertTrue(istracked(b[-1]))
+        self.assertTrue(b[-1]._tracker.path == ['a', 'b', 1])
+        self.assertTrue(all(istracked(value) for value in t['d']))
+        t['e'] = {}
+        self.assertTrue(type(d['e']) == dict)
+        self.assertTrue(istracked(t.get('e')))
+
     def test_vanilla_copy(self):
         l = [0, { 'a': 1 }]
         t = track(l)
@@ -41,6 +80,186 @@ class TestBasics(unittest.TestCase):
         self.assertTrue(type(back_to_l) == list)
         self.assertTrue(type(back_to_l[1]) == dict)
         
+    def test_snapshots(self):
+        t = track({'a': {'b': [1]}, 'c': {'d': 1}}, history=True)
+        t['c']['d'] = 2
+        first = snapshot(t)
+        self.assertTrue(type(first) == dict and type(first['a']['b']) == list)
+        self.assertTrue(snapshot(t) is first)
+        t['a']['b'].append(2)
+        second = snapshot(t)
+        self.assertTrue(first == {'a': {'b': [1]}, 'c': {'d': 2}}, first)
+        self.assertTrue(second['a']['b'] == [1, 2])
+        self.assertTrue(second['c'] is first['c'])
+        handler(t).history.undo()
+        self.assertTrue(snapshot(t) == first)
+
+        t = track({'a': {'b': [1]}}, lazy=True)
+        first = snapshot(t)
+        t['a']['b'].append(2)
+        self.assertTrue(first == {'a': {'b': [1]}}, first)
+        copied = deepcopy_tracked(t)
+        copied['a']['b'].append(3)
+        self.assertTrue(istracked(copied['a']['b']))
+        self.assertTrue(t == {'a': {'b': [1, 2]}}, t)
+        self.assertTrue(copied == {'a': {'b': [1, 2, 3]}}, copied)
+        self.assertTrue(snapshot(t)['a']['b'] == [1, 2])
+
+        # Lazy snapshots share the contents not read yet
+        d = {'a': {'b': [1]}}
+        t = track(d, lazy=True)
+        first = snapshot(t)
+        self.assertTrue(first['a'] is d['a'])
+        t['a']['b'].append(2)
+        self.assertTrue(first['a'] == {'b': [1]})
+
+        deep = track([])
+        node = deep
+        for i in range(1100):
+            node.append([])
+            node = node[0]
+        frozen = snapshot(deep)
+        for i in range(1100):
+            frozen = frozen[0]
+        self.assertTrue(frozen == [])
+
+    def test_deepcopy_tracked_options(self):
+        t = track({'a': {'b': [1]}}, 'source', persist=False,
+            history=5, path_prefix=['p'])
+        copied = deepcopy_tracked(t)
+        copied['a']['b'].append(2)
+        copied['a']['b'].append(3)
+        self.assertTrue(t == {'a': {'b': [1]}}, t)
+        copied_handler = copied._tracker.handler
+        self.assertTrue(copied_handler.name == 'source')
+        self.assertTrue(copied_handler.path_prefix == ['p'])
+        self.assertTrue(copied_handler.history.capacity == 5)
+        self.assertFalse(copied_handler.lazy)
+        copied_handler.history.undo()
+        self.assertTrue(copied == {'a': {'b': [1, 2]}}, copied)
+
+    def test_path_cache(self):
+        t = track({'a': [{'b': {'c': 1}}, {'b': {'c': 2}}]})
+        h = handler(t)
+        self.assertTrue(h.at(['a', 1, 'b', 'c']) == 2)
+        self.assertTrue(h.at(['a', 1, 'b']) is t['a'][1]['b'])
+        self.assertTrue(h.at(['a', -1, 'b']) is t['a'][1]['b'])
+        t['a'].insert(0, {'b': {'c': 0}})
+        self.assertTrue(h.at(['a', 1, 'b', 'c']) == 1)
+        self.assertTrue(h.at(['a', -1, 'b', 'c']) == 2)
+        t['a'][1]['b'] = {'c': 3}
+        self.assertTrue(h.at(['a', 1, 'b', 'c']) == 3)
+        t['a'][1].popitem()
+        with self.assertRaises(KeyError):
+            h.at(['a', 1, 'b'])
+        h.set(['a', 0, 'b', 'c'], 4)
+        self.assertTrue(t['a'][0]['b']['c'] == 4)
+        cached = h.path_cache['a']
+        t['e'] = {}
+        self.assertTrue(h.path_cache['a'] is cached)
+        t['a'].append({'b': {'c': 5}})
+        self.assertTrue(h.at(['a', -1, 'b', 'c']) == 5)
+
+        t = track({'a': {'b': 1}}, read_write_lock=True)
+        h = handler(t)
+        found = []
+        h.lock.acquire_read()
+        try:
+            reader = threading.Thread(
+                target=lambda: found.append(h.at(['a', 'b'])))
+            reader.start()
+            reader.join(5)
+            self.assertTrue(found == [1])
+        finally:
+            h.lock.release_read()
+
+    def test_detach_removed(self):
+        callback = mock.Mock()
+        t = track({'a': {'b': [1]}, 'c': [{'d': 1}]}, change_callback=callback)
+        a = t.pop('a')
+        b = a['b']
+        self.assertTrue(a._tracker.handler is not handler(t))
+        self.assertTrue(b._tracker.handler is not handler(t))
+        callback.reset_mock()
+        b.append(2)
+        a['e'] = {}
+        callback.assert_not_called()
+        self.assertTrue(a == {'b': [1, 2], 'e': {}})
+        t['f'] = a
+        self.assertTrue(b._tracker.handler is handler(t))
+        self.assertTrue(istracked(a['e']))
+        b.append(3)
+        self.assertTrue(callback.call_args.args[0].paths == {('f', 'b')})
+        self.assertTrue(snapshot(t)['f']['b'] == [1, 2, 3])
+        t['c'][0], t['c'][1:] = {'d': 2}, [t['c'][0]]
+        self.assertTrue(t['c'][1]._tracker.handler is handler(t))
+        t['c'].clear()
+        t['f'].clear()
+        self.assertFalse(b._tracker.handler is handler(t))
+
+        # Values stored at several keys stay tracked until all are removed
+        t['g'] = {'h': 1}
+        self.assertFalse(t['g']._tracker.shared)
+        t['i'] = shared = t['g']
+        self.assertTrue(shared._tracker.shared)
+        del t['i']
+        self.assertTrue(shared._tracker.handler is handler(t))
+        shared['h'] = 2
+        self.assertTrue(callback.call_args.args[0].paths == {('g',)})
+        t['c'].append(shared)
+        t['c'].append(shared)
+        del t['g']
+        t['c'].pop(0)
+        self.assertTrue(shared._tracker.handler is handler(t))
+        self.assertTrue(shared._tracker.path == ['c', 0])
+        t['c'].pop()
+        self.assertFalse(shared._tracker.handler is handler(t))
+
+    def test_fields_objects(self):
+        @dataclasses.dataclass(slots=True)
+        class Point:
+            x: int
+            y: list
+
+        class Slotted:
+            __slots__ = ('a', 'b')
+
+        callback = mock.Mock()
+        t = track([Point(1, [2])], change_callback=callback, history=True)
+        self.assertTrue(istracked(t[0]) and istracked(t[0].y))
+        t[0].x = {'c': 3}
+        self.assertTrue(istracked(t[0].x))
+        self.assertTrue(t[0].x._tracker.path == [0, 'x'])
+        self.assertTrue(callback.call_args.args[0].paths == {(0,)})
+        t[0].x = 4
+        handler(t).history.undo()
+        self.assertTrue(t[0].x == {'c': 3})
+        self.assertTrue(snapshot(t) == [Point({'c': 3}, [2])])
+
+        @dataclasses.dataclass
+        class Plain:
+            x: int
+
+        plain = Plain(1)
+        plain.extra = []
+        t = track(plain, change_callback=callback)
+        self.assertTrue(type(t) is CustomWrapper)
+        self.assertTrue(istracked(t.extra))
+        t.extra.append(2)
+        self.assertTrue(callback.call_args.args[0].paths == {('extra',)})
+        self.assertTrue(snapshot(t).extra == [2])
+
+        with mock.patch.dict(trackable_types, {Slotted: FieldsWrapper}):
+            slotted = Slotted()
+            slotted.a = []
+            t = track(slotted, history=True)
+            t.b = {}
+            self.assertTrue(istracked(t.a) and istracked(t.b))
+            del t.b
+            self.assertFalse(hasattr(slotted, 'b'))
+            handler(t).history.undo()
+            self.assertTrue(t.b == {})
+
 
 class TestChangeCallbacks(unittest.TestCase):
         
@@ -50,9 +269,132 @@ class TestChangeCallbacks(unittest.TestCase):
             self.assertTrue(type(data.name) == NoNameNoPersistence)
             self.assertTrue(data.path == [1])
             self.assertTrue(data.target==l[1])
+            self.assertTrue(data.func_name=='__setitem__')
+            self.assertTrue(data.args == (0, 2))
+            change = data.changes[0]
+            self.assertTrue(change.path == [1] and change.key == 0)
+            self.assertTrue(change.value == 2)
         t = track(l, change_callback=change_callback)
         t[1][0] = 2
 
+    def test_coalesced_changes(self):
+        notified = []
+        t = track({'a': {'b': [1]}, 'c': {}}, coalesce='batch',
+            change_callback=notified.append)
+        persist = handler(t).persist = mock.Mock()
+        with t:
+            for i in range(100):
+                t['a']['b'].append(i)
+            t['a']['d'] = i
+            self.assertTrue(notified == [])
+        self.assertTrue(len(notified) == 1)
+        self.assertTrue(len(notified[0].changes) == 101)
+        self.assertTrue(notified[0].paths == {('a', 'b'), ('a',)})
+        self.assertTrue(notified[0].path == ['a'])
+        self.assertTrue(notified[0].target is t['a'])
+        self.assertTrue(persist.dump.call_count == 1)
+        t['c']['e'] = 1
+        self.assertTrue(len(notified) == 2)
+
+        # Changes keep their paths when the target is removed later
+        notified.clear()
+        calls = []
+        subscribe(t, ['x'], lambda data: calls.append(data))
+        with t:
+            t['a']['x'] = 1
+            del t['a']
+        self.assertTrue(notified[0].changes[0].path == ['a'])
+        self.assertTrue(notified[0].paths == {('a',), ()})
+        self.assertTrue(calls == [])
+
+        notified.clear()
+        t = track({'a': 1, 'b': 2}, coalesce=10,
+            change_callback=notified.append)
+        t['a'] = 3
+        t['b'] = 4
+        self.assertTrue(notified == [])
+        self.assertTrue(handler(t).flush_timer.daemon)
+        Handler.flush_all()
+        self.assertTrue(len(notified) == 1)
+        self.assertTrue(notified[0].path == [])
+        self.assertTrue(handler(t).flush_timer is None)
+
+        handler(t).coalesce = 0.05
+        t['a'] = 5
+        time.sleep(0.2)
+        self.assertTrue(len(notified) == 2)
+
+    def test_subscriptions(self):
+        calls = []
+        t = track({'a': {'b': {'c': 1}, 'd': [1]}, 'e': 2})
+        for path in ([], ['a'], ['a', 'b'], ['a', 'b', 'c'], ['a', 'd', 0], ['e']):
+            subscribe(t, path,
+                lambda data, path=path: calls.append(path))
+        def changed(func):
+            calls.clear()
+            func()
+            return sorted(calls)
+        self.assertTrue(changed(lambda: t['a']['b'].update(c=2)) ==
+            [[], ['a'], ['a', 'b'], ['a', 'b', 'c']])
+        self.assertTrue(changed(lambda: t['a'].pop('b')) ==
+            [[], ['a'], ['a', 'b'], ['a', 'b', 'c']])
+        self.assertTrue(changed(lambda: t['a']['d'].insert(0, 0)) ==
+            [[], ['a'], ['a', 'd', 0]])
+        self.assertTrue(changed(lambda: t.update(e=3)) == [[], ['e']])
+        unsubscribe(t, ['e'], handler(t).subscriptions['e'].callbacks[0])
+        self.assertTrue('e' not in handler(t).subscriptions)
+        self.assertTrue(changed(lambda: t.update(e=4)) == [[]])
+        with self.assertRaises(ValueError):
+            unsubscribe(t, ['e'], print)
+
+    def test_bulk_operations(self):
+        notified = []
+        t = track({'l': [0, 1, 2, 3], 's': set(), 'd': {}}, history=True,
+            change_callback=notified.append)
+        persist = handler(t).persist = mock.Mock()
+        t['l'].bulk_extend({'i': i} for i in range(3))
+        t['d'].bulk_update(('k%d' % i, [i]) for i in range(3))
+        t['s'].bulk_update(['a', 'b', 'c'])
+        t['l'].bulk_delete([-1, 0, 2])
+        t['d'].bulk_delete(['k0', 'k2'])
+        t['s'].bulk_delete({'a', 'c'})
+        self.assertTrue(len(notified) == 6)
+        self.assertTrue(persist.dump.call_count == 6)
+        self.assertTrue(notified[1].changes[0].keys == ['k0', 'k1', 'k2'])
+        self.assertTrue(notified[-2].changes[0].keys == ['k0', 'k2'])
+        self.assertTrue(t == {
+            'l': [1, 3, {'i': 0}, {'i': 1}], 's': {'b'}, 'd': {'k1': [1]}}, t)
+        self.assertTrue(istracked(t['l'][3]) and istracked(t['d']['k1']))
+        self.assertTrue(t['l'][3]._tracker.path == ['l', 3])
+        with self.assertRaises(IndexError):
+            t['l'].bulk_delete([0, 4])
+        self.assertTrue(len(t['l']) == 4)
+        with self.assertRaises(KeyError):
+            t['d'].bulk_delete(['k1', 'k9'])
+        self.assertTrue('k1' in t['d'])
+        entries = handler(t).history.entries
+        t['l'].bulk_extend(iter(()))
+        t['l'].bulk_delete([])
+        t['d'].bulk_update({})
+        t['d'].bulk_delete([])
+        t['s'].bulk_delete(set())
+        self.assertTrue(len(notified) == 6)
+        self.assertTrue(persist.dump.call_count == 6)
+        self.assertTrue(handler(t).history.entries == entries)
+
+        g = track({'l': [0, 1, 2, 3], 's': {1, 2, 3}, 'd': {'a': 1, 'b': 2}})
+        g['l'].bulk_delete(index for index in (0, 1))
+        g['s'].bulk_delete(value for value in (1, 2))
+        g['d'].bulk_delete(key for key in 'ab')
+        g['s'].bulk_update(value for value in (4, 5))
+        self.assertTrue(
+            g == {'l': [2, 3], 's': {3, 4, 5}, 'd': {}}, g)
+        h = handler(t).history
+        h.undo()
+        h.undo()
+        h.undo()
+        self.assertTrue(t['l'] == [0, 1, 2, 3, {'i': 0}, {'i': 1}, {'i': 2}])
+
 
 class TestHistory(unittest.TestCase):
     
@@ -69,6 +411,132 @@ class TestHistory(unittest.TestCase):
         self.assertTrue(h.redo() == 0)
         self.assertTrue(data['a'] == [1, 2])
 
+    def test_history_operations(self):
+        data = track({'a': [1, 2, 3], 'b': {'c'}}, history=True)
+        h = handler(data).history
+        versions = [copy.deepcopy(data)]
+        def change(func):
+            func()
+            versions.append(copy.deepcopy(data))
+        change(lambda: data['a'].insert(0, {'d': 4}))
+        change(lambda: data['a'].pop(1))
+        change(lambda: data['a'].reverse())
+        change(lambda: data['b'].add('e'))
+        change(lambda: data.update(f=[5]))
+        change(lambda: data.popitem())
+        change(lambda: data['a'][2].clear())
+        self.assertTrue(len(h) == 7)
+        self.assertTrue(h[0][0].func_name == 'clear')
+        for version in reversed(versions[1:-1]):
+            h.undo()
+            self.assertTrue(data == version, data)
+        while h.active > 0:
+            h.redo()
+        self.assertTrue(data == versions[-1], data)
+        self.assertTrue(istracked(data['a'][2]))
+        self.assertTrue(data['a'][2]._tracker.path == ['a', 2])
+
+    def test_history_budget(self):
+        data = track({'a': []}, history=True)
+        h = handler(data).history
+        data['a'].append('x' * 1000)
+        self.assertTrue(h.bytes == 0)
+        h.budget = 20000
+        for i in range(20):
+            data['a'].append('x' * 1000 + str(i))
+        self.assertTrue(h.entries == len(h) < 20)
+        self.assertTrue(h.evictions == 21 - h.entries)
+        self.assertTrue(10000 < h.bytes <= h.budget, h.bytes)
+        self.assertTrue(h.bytes == sum(entry.size for entry in h))
+
+    def test_history_compression(self):
+        data = track({'a': [1, 2], 'b': {'c': 1}}, history=True)
+        h = handler(data).history
+        h.compress_after = 2
+        versions = [copy.deepcopy(data)]
+        def change(func):
+            func()
+            versions.append(copy.deepcopy(data))
+        change(lambda: data['a'].insert(0, {'d': [4]}))
+        change(lambda: data['a'][0]['d'].append(5))
+        change(lambda: data['b'].pop('c'))
+        change(lambda: data.update(e={'f'}))
+        change(lambda: data['a'].reverse())
+        self.assertTrue(isinstance(h[4], CompressedEntry))
+        self.assertTrue(h[4][0].func_name == 'insert')
+        for version in reversed(versions[1:-1]):
+            h.undo()
+            self.assertTrue(data == version, data)
+        while h.active > 0:
+            h.redo()
+        self.assertTrue(data == versions[-1], data)
+        self.assertTrue(data['a'][2]._tracker.path == ['a', 2])
+
+    def test_history_compression_unpicklable(self):
+        data = track({'a': []}, history=True)
+        h = handler(data).history
+        h.compress_after = 1
+        data['a'].append(threading.Lock())
+        data['a'].append(1)
+        data['a'].append(2)
+        self.assertTrue(h[2].serialized is None)
+        self.assertFalse(isinstance(h[2], CompressedEntry))
+        self.assertTrue(isinstance(h[1], CompressedEntry))
+        h.undo()
+        h.undo()
+        self.assertTrue(len(data['a']) == 1)
+
+    def test_history_goto(self):
+        data = track({'a': [], 'b': {}}, history=True)
+        h = handler(data).history
+        h.checkpoint_every = 3
+        states = {}
+        for i in range(12):
+            if i % 3 == 2:
+                data['a'].insert(0, {'i': i})
+            else:
+                data['b'][str(i % 4)] = [i]
+            states[h.latest_version] = copy.deepcopy(data)
+        self.assertTrue(
+            [entry.version for entry in h if entry.checkpoint is not None]
+            == [10, 7, 4, 1])
+        items, later = data['a'], data['a'][0]
+        self.assertTrue(h.goto(2) == 10)
+        self.assertTrue(data == states[2], data)
+        self.assertTrue(data['a'] is items)
+        self.assertFalse(later._tracker.handler is handler(data))
+        self.assertTrue(h.by_path)
+        for version in (11, 5, 6, 1, 12):
+            h.goto(version)
+            self.assertTrue(data == states[version], (version, data))
+        self.assertTrue(h.active == 0)
+        self.assertTrue(data['a'][2]['i'] == 5)
+        self.assertTrue(data['a'][2]._tracker.path == ['a', 2])
+        with self.assertRaises(ValueError):
+            h.goto(13)
+
+    def test_history_goto_nested(self):
+        data = track({}, history=True)
+        h = handler(data).history
+        h.checkpoint_every = 3
+        data['a'] = 1
+        data['b'] = {'x': []}
+        for i in range(10):
+            data['b']['x'].append(i)
+        h.goto(2)
+        self.assertTrue(data == {'a': 1, 'b': {'x': []}}, data)
+        x = data['b']['x']
+        h.goto(7)
+        self.assertTrue(data['b']['x'] == [0, 1, 2, 3, 4], data)
+        # References kept across checkpoint restores stay tracked
+        self.assertTrue(data['b']['x'] is x)
+        self.assertTrue(x._tracker.handler is handler(data))
+        x.append('new')
+        self.assertTrue(h.entries == 8)
+        h.undo()
+        self.assertTrue(data['b']['x'] == [0, 1, 2, 3, 4], data)
+
+
 class TestContextManagers(unittest.TestCase):
     
     def test_lock_ctxtmgr(self):
@@ -79,6 +547,45 @@ class TestContextManagers(unittest.TestCase):
         with self.assertRaises(RuntimeError):
             t._tracker.handler.lock.release()
             
+    def test_read_waits_for_writer(self):
+        t = track({'a': [1]})
+        writing = threading.Event()
+        def writer():
+            with t:
+                writing.set()
+                time.sleep(0.1)
+                t['a'].append(2)
+        thread = threading.Thread(target=writer)
+        thread.start()
+        writing.wait()
+        self.assertTrue(len(t['a']) == 2)
+        thread.join()
+        with t:
+            self.assertTrue(len(t['a']) == 2)
+
+    def test_read_write_lock(self):
+        t = track({'a': {'b': [1]}}, read_write_lock=True)
+        lock = handler(t).lock
+        events = []
+        lock.acquire_read()
+        def writer():
+            with atomic(t):
+                events.append('write')
+                t['a']['b'].append(2)
+        thread = threading.Thread(target=writer)
+        thread.start()
+        time.sleep(0.1)
+        self.assertTrue(events == [])
+        self.assertTrue(istracked(t['a']['b']))
+        events.append('read')
+        lock.release_read()
+        thread.join()
+        self.assertTrue(events == ['read', 'write'])
+        self.assertTrue(t['a']['b'] == [1, 2])
+        self.assertTrue(lock.readers == {} and lock.writer is None)
+        t = track({'a': {'b': [1]}}, lazy=True, read_write_lock=True)
+        self.assertTrue(istracked(t['a']['b']))
+
     def test_atomic_ctxtmgr_baseline(self):
         t = track({'a': 1})
         with atomic(t):
@@ -101,7 +608,38 @@ class TestContextManagers(unittest.TestCase):
         self.assertTrue(t == original, t)
         self.assertTrue(istracked(t['a']))
         self.assertTrue(call_count == 0, call_count)
-        
+
+        def failing():
+            yield {'c': 2}
+            raise RuntimeError('Failed while extending')
+        t = track({'a': [1]})
+        with self.assertRaises(RuntimeError):
+            with atomic(t):
+                t['a'].extend(failing())
+        self.assertTrue(t == {'a': [1]}, t)
+
+    def test_atomic_ctxtmgr_journal(self):
+        changes = []
+        t = track({'a': [1]}, history=True,
+            change_callback=lambda data: changes.append(data.changes))
+        t['a'][0] = 1
+        with atomic(t):
+            t['a'].append(2)
+            with self.assertRaises(RuntimeError):
+                with atomic(t):
+                    t['a'].insert(0, 0)
+                    t['b'] = {}
+                    raise RuntimeError('Inner block failed')
+            t['c'] = 3
+        self.assertTrue(t == {'a': [1, 2], 'c': 3}, t)
+        self.assertTrue(len(changes) == 2)
+        self.assertTrue(
+            [change.func_name for change in changes[1]] ==
+            ['append', '__setitem__'])
+        self.assertTrue(handler(t).journal is None)
+        handler(t).history.undo()
+        self.assertTrue(t == {'a': [1]}, t)
+
 
 class TestPersistence(unittest.TestCase):
     
@@ -112,7 +650,8 @@ class TestPersistence(unittest.TestCase):
         m.assert_any_call('testing.yaml', encoding='utf-8')
         m.assert_called_with('testing.yaml', 'w', encoding='utf-8')
         h = m()
-        [h.write.assert_any_call(letter) for letter in 'ä: 1\n']
+        written = ''.join(call.args[0] for call in h.write.call_args_list)
+        self.assertTrue(written == 'ä: 1\n', written)
         
     def test_existing_file(self):
         file_content = 'ä: 1\n'
@@ -121,6 +660,235 @@ class TestPersistence(unittest.TestCase):
             t = track({}, 'testing')
         m.assert_called_once_with('testing.yaml', encoding='utf-8')
         self.assertTrue(t['ä'] == 1)
+
+    def test_file_formats(self):
+        data = {'a': [1, {'b': 'ä'}], 'c': {'d': None}}
+        with tempfile.TemporaryDirectory() as directory:
+            for file_class in (SafeYamlFile, JsonFile, PickleFile):
+                name = os.path.join(directory, file_class.file_format)
+                t = track(copy.deepcopy(data), name, persist=file_class(name))
+                t['a'][1]['e'] = 2
+                loaded = track({}, name, persist=file_class(name))
+                self.assertTrue(loaded == t, (file_class, loaded))
+            json_file = JsonFile(os.path.join(directory, 'plain'))
+            json_file.orjson = None
+            json_file.dump(track(copy.deepcopy(data)))
+            self.assertTrue(json_file.load() == data)
+
+    def test_json_dbm_shards(self):
+        with tempfile.TemporaryDirectory() as directory:
+            name = os.path.join(directory, 'testing')
+            persistence = JsonDBM(name, depth=2)
+            t = track({'a': {'b': {'c': 1}, 'd': [2]}, 'e': 3, 'f': {}},
+                name, persist=persistence, dot_access=True)
+            self.assertTrue(persistence.stored == {
+                ('a', 'b'), ('a', 'd'), ('e',), ('f',)})
+            with mock.patch('tinysync.persistence.json.dumps',
+                    wraps=json.dumps) as dumps:
+                t['a']['b']['c'] = 4
+            self.assertTrue([
+                call.args[0] for call in dumps.call_args_list
+                if 'default' in call.kwargs
+            ] == [{'c': 4}])
+            self.assertTrue(persistence.load_specific(('a', 'b')) == {'c': 4})
+            t['f']['g'] = {'h': 5}
+            t['a'].pop('d')
+            self.assertTrue(persistence.stored == {
+                ('a', 'b'), ('e',), ('f', 'g')})
+            persistence.db.close()
+
+            persistence = JsonDBM(name, depth=2, flag='c')
+            t = track({}, name, persist=persistence, dot_access=True)
+            self.assertTrue(isinstance(t.__subject__['a'], LazyLoadMarker))
+            self.assertTrue(isinstance(
+                t['a'].__subject__['b'], LazyLoadMarker))
+            self.assertTrue(t['a']['b'] == {'c': 4})
+            self.assertTrue(t['f']['g']['h'] == 5)
+            self.assertTrue(t['e'] == 3)
+            persistence.db.close()
+
+    def test_lazy_loading_reads(self):
+        with tempfile.TemporaryDirectory() as directory:
+            name = os.path.join(directory, 'testing')
+            persistence = JsonDBM(name, depth=2)
+            track({'a': {'b': [{'c': 1}]}, 'd': 2, 'e': {'f': 3}},
+                name, persist=persistence)
+            persistence.db.close()
+
+            persistence = JsonDBM(name, depth=2, flag='c')
+            t = track({}, name, persist=persistence)
+            self.assertTrue(t.get('d') == 2)
+            self.assertTrue(dict(t['a'].items()) == {'b': [{'c': 1}]})
+            self.assertTrue({'f': 3} in list(t.values()))
+            self.assertTrue({'c': 1} in t['a']['b'])
+            self.assertFalse(any(
+                isinstance(value, LazyLoadMarker)
+                for value in t.__subject__.values()))
+            t['a']['b'][0]['c'] = 4
+            persistence.db.close()
+
+            persistence = JsonDBM(name, depth=2, flag='c')
+            t = track({}, name, persist=persistence)
+            self.assertTrue(t['a']['b'][0]['c'] == 4)
+            persistence.db.close()
+
+            persistence = JsonDBM(name, depth=2, flag='c')
+            t = track({}, name, persist=persistence)
+            self.assertTrue(snapshot(t) == {
+                'a': {'b': [{'c': 4}]}, 'd': 2, 'e': {'f': 3}})
+            persistence.db.close()
+
+            persistence = JsonDBM(name, depth=2, flag='c')
+            t = track({}, name, persist=persistence)
+            self.assertTrue('LazyLoadMarker' not in repr(t))
+            persistence.db.close()
+
+            persistence = JsonDBM(name, depth=2, flag='c')
+            t = track({}, name, persist=persistence)
+            self.assertTrue(f'{t["a"]}' == "{'b': [{'c': 4}]}")
+            self.assertTrue('LazyLoadMarker' not in str(t))
+            persistence.db.close()
+
+            persistence = JsonDBM(name, depth=2, flag='c')
+            t = track({}, name, persist=persistence)
+            copied = copy.deepcopy(t)
+            self.assertTrue(type(copied['a']['b']) is list)
+            self.assertTrue(copied == {
+                'a': {'b': [{'c': 4}]}, 'd': 2, 'e': {'f': 3}}, copied)
+            persistence.db.close()
+
+            persistence = JsonDBM(name, depth=2, flag='c')
+            t = track({}, name, persist=persistence)
+            self.assertTrue(t['a'].copy() == {'b': [{'c': 4}]})
+            self.assertTrue(t.setdefault('d', 5) == 2)
+            self.assertTrue(t.pop('d') == 2)
+            self.assertTrue(t.popitem() == ('e', {'f': 3}))
+            self.assertTrue(t['a'].pop('b').pop() == {'c': 4})
+            persistence.db.close()
+
+    def test_resident_limit(self):
+        with tempfile.TemporaryDirectory() as directory:
+            name = os.path.join(directory, 'testing')
+            persistence = JsonDBM(name)
+            track({key: {'value': key} for key in 'abcde'},
+                name, persist=persistence)
+            persistence.db.close()
+            persistence = JsonDBM(name, flag='c')
+            t = track({}, name, persist=persistence, dot_access=True,
+                coalesce=10, resident_entries=2)
+            a = t['a']
+            a['value'] = 'changed'
+            t['b']
+            t['a']
+            t['c']
+            loaded = lambda: sorted(
+                key for key, value in t.__subject__.items()
+                if not isinstance(value, LazyLoadMarker))
+            self.assertTrue(loaded() == ['a', 'c'], loaded())
+            t['d']
+            self.assertTrue(loaded() == ['c', 'd'], loaded())
+            self.assertTrue(persistence.load_specific('a')['value'] == 'changed')
+            a['value'] = 'again'
+            self.assertTrue(t.__subject__['a'] is a)
+            t['b']
+            t['c']
+            self.assertTrue(isinstance(t.__subject__['a'], LazyLoadMarker))
+            self.assertTrue(t['a'] is a)
+            e = t['e']
+            t['c']
+            t['d']
+            del t['e']
+            e['value'] = 'removed'
+            self.assertFalse(e._tracker.handler is handler(t))
+            flush(t)
+            self.assertTrue(persistence.load_specific('a')['value'] == 'again')
+            self.assertFalse(persistence.db.get('e'))
+            persistence.db.close()
+
+            persistence = JsonDBM(name, flag='c')
+            t = track({}, name, persist=persistence, dot_access=True,
+                resident_bytes=1000)
+            for key in 'abcd':
+                t[key]
+            self.assertTrue(0 < len(loaded()) < 4, loaded())
+            values = t.values()
+            self.assertTrue(len(values) == 4)
+            self.assertTrue(
+                [value['value'] for value in values] == ['again', 'b', 'c', 'd'])
+            self.assertTrue(list(values) == list(values))
+            self.assertTrue(('b', {'value': 'b'}) in t.items())
+            persistence.db.close()
+
+    def test_write_behind(self):
+        dumped = []
+        writing = threading.Event()
+        proceed = threading.Event()
+
+        class SlowPersistence(Persistence):
+            snapshot_dumps = True
+            def dump(self, to_save, handler=None, conflict_callback=None,
+                    initial=False):
+                dumped.append(copy.copy(to_save))
+                writing.set()
+                proceed.wait(1)
+
+        t = track([], write_behind=True)
+        handler(t).persist = SlowPersistence()
+        t.append(1)
+        writing.wait(1)
+        t.append(2)
+        t.append(3)
+        self.assertTrue(dumped == [[1]])
+        proceed.set()
+        flush(t)
+        self.assertTrue(dumped == [[1], [1, 2, 3]], dumped)
+        self.assertTrue(type(dumped[-1]) == list)
+
+    def test_write_behind_workers_end(self):
+        threads = threading.enumerate()
+        handlers = []
+        for i in range(10):
+            t = track([], write_behind=True)
+            handler(t).persist = Persistence()
+            t.append(i)
+            flush(t)
+            handlers.append(weakref.ref(t._tracker.handler))
+        del t
+        gc.collect()
+        for thread in threading.enumerate():
+            if thread not in threads:
+                thread.join(1)
+        self.assertTrue(threading.active_count() <= len(threads))
+        self.assertFalse(any(ref() for ref in handlers))
+
+    def test_journal_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            name = os.path.join(directory, 'testing')
+            journal = JournalFile(name)
+            t = track({'a': [1], 'b': {'c': {2}}}, name,
+                persist=journal, history=True)
+            t['a'].append({'d': 3})
+            t['a'][1]['d'] = 4
+            t['b']['c'].add(5)
+            t['b'].pop('c')
+            t['e'] = 6
+            handler(t).history.undo()
+            flush(t)
+            journal.close()
+            expected = {'a': [1, {'d': 4}], 'b': {}}
+            self.assertTrue(t == expected)
+            with open(journal.log_name(0), 'ab') as fp:
+                fp.write(b'\x10\x00\x00\x00partial')
+            journal = JournalFile(name, compact_after=100)
+            t = track({}, name, persist=journal)
+            self.assertTrue(t == expected, t)
+            for i in range(10):
+                t['a'].append(i)
+            journal.close()
+            self.assertTrue(journal.generation > 0)
+            self.assertTrue(journal.generations() == [journal.generation])
+            t = track({}, name, persist=JournalFile(name))
+            self.assertTrue(t['a'] == [1, {'d': 4}] + list(range(10)))
     
     
 class TestQueueControl(unittest.TestCase):
@@ -1,9 +1,11 @@
 # coding: utf-8
 
 from collections.abc import MutableSequence, MutableMapping, MutableSet
+from collections import OrderedDict
 from types import SimpleNamespace
 import copy, itertools, uuid, pprint
-import sys, io
+import sys, io, zlib, weakref, pickle, atexit
+from sys import getsizeof
 import importlib
 import threading
 from contextlib import contextmanager
@@ -30,6 +32,12 @@ def track(
     conflict_callback=None,
     path_prefix=None,
     dot_access=None,
+    lazy=False,
+    read_write_lock=False,
+    coalesce=None,
+    write_behind=False,
+    resident_entries=None,
+    resident_bytes=None,
 ):
     """ Main function to start tracking changes to structures.
 
@@ -55,6 +63,32 @@ def track(
     tracked structures’ dict values to be accessible with the attribute-like
     dot notation. Default is False unless changed globally by calling the
     `dot_off` function.
+    * `lazy`: Optional - If True, contained dicts, lists, sets and objects
+    are only wrapped for tracking when they are first read through a tracked
+    parent, instead of wrapping the whole structure up front. Untouched parts
+    of the structure stay as they are.
+    * `read_write_lock`: Optional - If True, reads from different threads
+    can proceed in parallel, while changes wait until the ongoing reads have
+    completed and get exclusive access. By default, reads do not lock at all
+    unless another thread is making changes.
+    * `coalesce`: Optional - Merges changes into one change notification, sync
+    update and save. Either the window in seconds, counted from the first
+    change, or `'batch'` to merge the changes made within a `with tracked:`
+    block until the outermost block exits. Use `flush` to send out the pending
+    changes right away. Default is None, notifying every change separately.
+    When the window ends, `change_callback`, subscribers, sync and save run in
+    a background timer thread. Pending changes are flushed when Python exits.
+    * `write_behind`: Optional - If True, changes are saved in a background
+    thread instead of the thread making the change, and all the changes made
+    while a save is in progress are saved together. Use `flush` to wait for the
+    changes to be saved. Pending changes are also saved when Python exits.
+    * `resident_entries`, `resident_bytes`: Optional - Limits on the values
+    loaded lazily from a key-value store persistence like `JsonDBM`, as the
+    number of loaded values or their estimated size in bytes. When a limit is
+    exceeded, the least recently used values are replaced with markers again,
+    to be reloaded when needed. Pending changes are saved first. Evicted values
+    that are still referenced elsewhere stay usable: they are put back in the
+    structure when changed, and reused when reloaded.
     """
 
     tracked = None
@@ -92,6 +126,12 @@ def track(
         conflict_callback,
         path_prefix,
         dot_access,
+        lazy,
+        read_write_lock,
+        coalesce,
+        write_behind,
+        resident_entries,
+        resident_bytes,
     )
 
     if persistence is not None and initial:
@@ -104,24 +144,32 @@ def atomic(tracked, remote=False):
     """ Context manager used to ensure that
     all the changes are applied to the tracked data structure, or none.
     Delays any change notifications, saves and syncs until successful
-    completion of the context. """
+    completion of the context.
 
+    Changes made within the context are recorded in a journal on the
+    handler. On failure, the journal is used to roll the changes back,
+    and on success it is passed on as the list of changes. Nested
+    contexts share the journal of the outermost one. """
+
+    tracked_handler = handler(tracked)
     with tracked:
-        handler(tracked).track = False
-        backup_copy = copy.deepcopy(tracked)
+        outermost = tracked_handler.journal is None
+        if outermost:
+            tracked_handler.journal = []
+        journal = tracked_handler.journal
+        start = len(journal)
         try:
             yield #transient_copy
         except:
-            tracked.__subject__ = backup_copy
-            handler(tracked).start_to_track(tracked, [], force=True)
-            handler(tracked).track = True
+            for operation in reversed(journal[start:]):
+                operation.undo()
+            del journal[start:]
             raise
-        else:
-            all_changes = list(dictdiffer.diff(backup_copy, tracked))
-            handler(tracked).track = True
-    handler(tracked).on_change(tracked, all_changes, remote)
-        #finally:
-        #    tracked._tracker.handler.tracked = True
+        finally:
+            if outermost:
+                tracked_handler.journal = None
+    if outermost and journal:
+        tracked_handler.on_change(tracked, journal, remote)
 
     '''
         handler.save_changes = False
@@ -133,6 +181,25 @@ def atomic(tracked, remote=False):
         if handler.sync is not None:
             handler.sync.update_others()
     '''
+
+def subscribe(tracked, path_prefix, callback):
+    """ Subscribes `callback` to the changes in the part
+    of the tracked structure found at `path_prefix`, given
+    as a list of keys. See `Handler.subscribe`. """
+    handler(tracked).subscribe(path_prefix, callback)
+
+def unsubscribe(tracked, path_prefix, callback):
+    handler(tracked).unsubscribe(path_prefix, callback)
+
+def flush(tracked):
+    """ Sends out any change notifications held back by
+    the `coalesce` option of the tracked structure, and
+    syncs and saves the changes. With the `write_behind`
+    option, waits until the changes have been saved. """
+    tracked_handler = handler(tracked)
+    tracked_handler.flush()
+    if tracked_handler.writer is not None:
+        tracked_handler.writer.flush()
     
 
 class Handler:
@@ -140,6 +207,9 @@ class Handler:
     persistence_default = SafeYamlFile
     dot_access_default = False
 
+    # Handlers with a coalescing window, flushed at exit
+    coalescing = weakref.WeakSet()
+
     def __init__(
         self,
         subject,
@@ -151,9 +221,15 @@ class Handler:
         conflict_callback,
         path_prefix,
         dot_access,
+        lazy=False,
+        read_write_lock=False,
+        coalesce=None,
+        write_behind=False,
+        resident_entries=None,
+        resident_bytes=None,
     ):
 
-        self.lock = threading.RLock()
+        self.lock = ReadWriteLock() if read_write_lock else WriteLock()
 
         self.name = name
         self.persist = persist
@@ -164,16 +240,32 @@ class Handler:
         #self.change_paths = ChangePathItem()
         self.save_changes = True
         self.track = True
+        self.lazy = lazy
+        self.lazy_loading = getattr(persist, 'lazy_loading', False)
+        self.journal = None
+        self.copy_on_wrap = False
+        self.coalesce = coalesce
+        self.pending = []
+        self.pending_lock = threading.Lock()
+        self.flush_timer = None
+        self.subscriptions = Subscriptions()
+        self.path_cache = {}
+        self.writer = PersistenceWorker(self) if write_behind else None
+        self.resident = (
+            Resident(resident_entries, resident_bytes)
+            if resident_entries is not None or resident_bytes is not None
+            else None
+        )
         self.history = None if not history else History(self, 0 if history is True else history)
 
         dot_access_on = (
             dot_access if dot_access is not None else self.dot_access_default
         )
-        self.trackable_types = trackable_types.copy()
+        self.trackable_types = trackable_types
         if dot_access_on:
             self.trackable_types[MutableMapping] = DictWrapper_Dot
 
-        self.root = self.start_to_track(subject, path_prefix)
+        self.root = self.start_to_track(subject)
 
         if sync_conduit is not False:
             sync_name = 'default' if type(name) is not str else name
@@ -193,7 +285,6 @@ class Handler:
         if not self.track:
             return
             
-        self.make_updates(target)
         #self.record_change_footprint(target._tracker.path)
 
         #if self.change_action:
@@ -202,89 +293,568 @@ class Handler:
         if self.history is not None:
             self.history.new_entry(changes)
 
+        with self.pending_lock:
+            self.pending.append((target, changes, remote))
+            if (
+                isinstance(self.coalesce, (int, float))
+                and self.flush_timer is None
+            ):
+                self.flush_timer = threading.Timer(self.coalesce, self.flush)
+                self.flush_timer.daemon = True
+                self.flush_timer.start()
+                self.coalescing.add(self)
+
+        if self.coalesce is None or (
+            self.coalesce == 'batch' and self.lock.writer != threading.get_ident()
+        ):
+            self.flush()
+
+    def flush(self):
+        """ Notifies the pending changes as one change, and syncs
+        and saves them once. The notification `path` and `target`
+        are those of the closest node containing all the changes,
+        `paths` is the set of the changed paths, and `changes` the
+        list of `Change` records. If there is only one change,
+        `func_name` and `args` are those of the changing call.
+
+        Callbacks, sync and save run in the calling thread, which
+        is the timer thread when a `coalesce` window ends. """
+        with self.pending_lock:
+            pending, self.pending = self.pending, []
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+        if not pending:
+            return
+
+        changes = []
+        paths = set()
+        for target, target_changes, remote in pending:
+            changes.extend(target_changes)
+            paths.update(tuple(change.path) for change in target_changes)
+        if len(paths) == 1:
+            target = pending[0][0]
+            path = list(next(iter(paths)))
+        else:
+            path = []
+            for keys in zip(*paths):
+                if len(set(keys)) > 1:
+                    break
+                path.append(keys[0])
+            target = self.at(path[len(self.path_prefix):])
+
+        single = changes[0] if len(changes) == 1 else None
+        change_data = SimpleNamespace(
+            name=self.name,
+            root=self.root,
+            path=path,
+            paths=paths,
+            target=target,
+            changes=changes,
+            func_name=single and single.func_name,
+            args=single and single.args,
+        )
+
         if self.change_callback:
-            change_data = SimpleNamespace(
-                name=self.name,
-                root=self.root,
-                path=target._tracker.path,
-                target=target,
-                changes=changes
-            )
             self.change_callback(change_data)
 
+        if self.subscriptions or self.subscriptions.callbacks:
+            subscribers = {}
+            with self.pending_lock:
+                for change in changes:
+                    subscribers.update(dict.fromkeys(
+                        self.subscriptions.matching(change.path, change.keys)))
+            for callback in subscribers:
+                callback(change_data)
+
+        remote = all(remote for _, _, remote in pending)
         if not remote and self.sync_on and self.sync is not None:
             self.sync.update_others()
 
-        if self.persist is not None:
+        if self.writer is not None:
+            self.writer.add(change_data, self.save_changes)
+        elif self.persist is not None:
             self.persist.change_advisory(change_data)
             if self.save_changes:
                 self.save()
 
+    @classmethod
+    def flush_all(cls):
+        for handler in list(cls.coalescing):
+            handler.flush()
+
+    def subscribe(self, path_prefix, callback):
+        """ Calls `callback` with the change notification whenever
+        there are changes at or below the path `path_prefix`, including
+        changes that replace or remove the value at the path. """
+        with self.pending_lock:
+            self.subscriptions.add(path_prefix, callback)
+
+    def unsubscribe(self, path_prefix, callback):
+        with self.pending_lock:
+            self.subscriptions.remove(path_prefix, callback)
+
     def save(self):
         if self.persist is not None:
             self.persist.dump(self.root, self, self.conflict_callback)
 
-    def load(self, key, path):
-        value = self.persist.load_specific(key)
-        tracked_value = self.start_to_track(value, path + [key])
-        return tracked_value
+    @property
+    def journaling(self):
+        """ True if the persistence records each change as it is
+        made, see `JournalFile`. """
+        return (
+            self.persist is not None
+            and getattr(self.persist, 'journaling', False) is True
+        )
 
-    def start_to_track(self, target, path, force=False):
-        if not force and (
-            istracked(target) or isinstance(target, LazyLoadMarker)
+    def log_write(self, operation, values, current, location):
+        """ Passes a write of `values` over the `current` contents of
+        the region of `operation`, in the object at `location`, to the
+        journaling persistence. Called at the time of the change, under
+        the lock. """
+        self.persist.record(operation.written(
+            values, current, location[len(self.path_prefix):]))
+
+    def load(self, key, parent, marker=None):
+        """ Loads the value at `key` of `parent`, represented by the
+        `LazyLoadMarker` marker, from the persistence, and replaces
+        the marker with it. The loaded value can itself contain
+        markers for the parts that are loaded later. """
+        with self.lock:
+            subject = parent.__subject__
+            items = self.get_items(subject, [key])
+            if not items:
+                return marker
+            current = items[0][1]
+            if not isinstance(current, LazyLoadMarker):
+                return self.child(parent, key, current)
+            storage_key = key if current.key is None else current.key
+            value = None
+            if self.resident is not None:
+                value = self.resident.evicted.pop((id(parent), key), None)
+            if value is None or value._tracker.handler is not self:
+                value = self.persist.load_specific(storage_key)
+                if self.should_upgrade(value):
+                    value = self.start_to_track(value, parent, key)
+            self.set_value(subject, key, current, value)
+            if self.resident is not None:
+                self.resident.add(parent, key, storage_key, value)
+                self.evict()
+        return value
+
+    def evict(self):
+        """ Replaces the least recently used loaded values with markers
+        until the number and size of the loaded values are within the
+        limits, keeping the latest one. Pending changes are saved first,
+        so that nothing is lost.
+
+        Evicted tracked values stay attached, and are only referred to
+        weakly, so that they can still be changed through references
+        held elsewhere, see `reinstate`, and are reused if reloaded
+        while still in memory. """
+        resident = self.resident
+        if not resident.over_limit() or not self.save_changes:
+            return
+        self.flush()
+        if self.writer is not None:
+            self.writer.flush()
+        elif self.persist is not None and (
+            getattr(self.persist, 'changed_keys', None)
+            or getattr(self.persist, 'deleted_keys', None)
         ):
-            return target
-
-        tracked = None
+            self.save()
+        while resident.over_limit() and len(resident) > 1:
+            parent, key, storage_key, value = resident.pop_oldest()
+            subject = parent.__subject__
+            if parent._tracker.handler is not self:
+                continue
+            items = self.get_items(subject, [key])
+            if not items or items[0][1] is not value:
+                continue
+            self.set_value(
+                subject, key, value, LazyLoadMarker(storage_key))
+            if istracked(value):
+                resident.evicted[(id(parent), key)] = value
+            if self.path_cache:
+                self.forget_paths(parent, [key])
 
-        for abc in self.trackable_types:
-            if isinstance(target, abc):
-                tracked = self.trackable_types[abc](target, path, self)
+    @property
+    def trackable_types(self):
+        """ Types tracked by this handler, see `TrackableTypes`.
+        Changing the mapping, or setting a new one, clears the
+        cache of resolved types. """
+        return self._trackable_types
+
+    @trackable_types.setter
+    def trackable_types(self, value):
+        self._trackable_types = TrackableTypes(value)
+
+    def start_to_track(self, target, parent=None, key=None):
+        """ Wraps the target for tracking, as the value at `key` of the
+        tracked `parent`, or as the root if no parent is given. """
+        if istracked(target) or isinstance(target, LazyLoadMarker):
+            return target
 
-        if tracked is None and hasattr(target, "__dict__"):
-            tracked = CustomWrapper(target, path, self)
+        wrapper_class = self.trackable_types.wrapper_for(target)
 
-        if tracked is not None:
-            self.make_updates(tracked)
+        if wrapper_class is not None:
+            if self.lazy or self.lazy_loading:
+                wrapper_class = lazy_wrapper_for(wrapper_class)
+            tracked = wrapper_class(target, self, parent, key)
+            if not self.lazy:
+                self.make_updates(tracked)
             return tracked
 
         raise TypeError(
             "'%s' does not have a trackable type: %s" % (target, type(target))
         )
 
-    def make_updates(self, node):
+    def make_updates(self, node, keys=None, forget=True):
         """ Checks to see if some of the changed node's contents now need to 
         be tracked.
+
+        If `keys` is given, only the values at those keys are checked,
+        otherwise all the contents of the node. Cached paths through the
+        keys are dropped, unless `forget` is false, i.e. the change only
+        added values and did not remove or move any tracked ones.
         """
 
+        if forget and self.path_cache:
+            self.forget_paths(node, keys)
+
+        tracker = node._tracker
+        while tracker.frozen is not None:
+            tracker.frozen = None
+            if tracker.parent is None:
+                break
+            tracker = tracker.parent._tracker
+
         to_upgrade = []
-        for key, value in self.get_iterable(node):
-            if self.should_upgrade(value):
+        if keys is None:
+            iterable = self.get_iterable(node.__subject__)
+        else:
+            iterable = self.get_items(node.__subject__, keys)
+        for key, value in iterable:
+            if istracked(value):
+                tracker = value._tracker
+                parent = tracker.parent
+                if (
+                    parent is not None and not tracker.shared
+                    and (parent is not node or tracker.key != key)
+                    and tracker.handler is self
+                ):
+                    tracker.shared = self.holds(parent, tracker.key, value)
+                tracker.parent = node
+                tracker.key = key
+                if tracker.handler is detached:
+                    self.attach(value)
+            elif not self.lazy and self.should_upgrade(value):
                 to_upgrade.append((key, value))
-            else:
-                if istracked(value):
-                    value._tracker.path = node._tracker.path + [key]
         for key, value in to_upgrade:
             self.set_value(
                 node.__subject__,
                 key,
                 value,
-                self.start_to_track(value, node._tracker.path + [key]),
+                self.start_to_track(value, node, key),
             )
 
-    def should_upgrade(self, contained):
-        if istracked(contained):
-            return False
-
-        for abc in trackable_types.keys():
-            if isinstance(contained, abc):
-                return True
-        if hasattr(contained, "__dict__"):
-            return True
-        if hasattr(contained, "__hash__"):
-            return False
+    def detach_removed(self, node, values, keys):
+        """ Detaches the tracked `values` that were in the changed
+        region of `node`, unless they are still found at the `keys`
+        touched by the change. Values that have been stored at
+        several keys are detached only if they are no longer
+        reachable from their parent: the key recorded by the tracker
+        is checked before going through the rest of the parent's
+        contents. """
+        subject = node.__subject__
+        present = {
+            id(value) for key, value in (
+                self.get_iterable(subject) if keys is None
+                else self.get_items(subject, keys)
+            )
+        }
+        contents = {}
+        for value in values:
+            tracker = value._tracker
+            if id(value) in present or tracker.handler is not self:
+                continue
+            parent = tracker.parent
+            if (
+                tracker.shared and parent is not None
+                and parent._tracker.handler is self
+            ):
+                if self.holds(parent, tracker.key, value):
+                    continue
+                found = contents.get(id(parent))
+                if found is None:
+                    found = contents[id(parent)] = {
+                        id(item): key for key, item
+                        in self.get_iterable(parent.__subject__)
+                    }
+                if id(value) in found:
+                    tracker.key = found[id(value)]
+                    continue
+            self.detach(value)
+
+    def holds(self, parent, key, value):
+        """ True if `value` is still found at `key` of `parent`. """
+        items = self.get_items(parent.__subject__, [key])
+        return bool(items) and items[0][1] is value
+
+    def reinstate(self, node):
+        """ Called before a change to `node`. If the node, or a node
+        containing it, has been evicted, it is put back in the place of
+        its marker, so that the change is saved. If the marker has since
+        been removed, the evicted node is detached instead. """
+        evicted = self.resident.evicted
+        if not evicted:
+            return
+        with self.lock:
+            current = node
+            while current._tracker.parent is not None:
+                parent, key = current._tracker.parent, current._tracker.key
+                if evicted.get((id(parent), key)) is current:
+                    del evicted[(id(parent), key)]
+                    subject = parent.__subject__
+                    items = self.get_items(subject, [key])
+                    marker = items[0][1] if items else None
+                    if not isinstance(marker, LazyLoadMarker):
+                        self.detach(current)
+                        return
+                    self.set_value(subject, key, marker, current)
+                    self.resident.add(parent, key,
+                        key if marker.key is None else marker.key, current)
+                current = parent
+
+    def detach(self, node):
+        """ Detaches the tracked `node`, removed from the structure,
+        and the tracked values in it, see `DetachedHandler`. """
+        node._tracker.parent = None
+        node._tracker.shared = False
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            node._tracker.handler = detached
+            for key, value in self.get_iterable(node.__subject__):
+                if istracked(value) and value._tracker.handler is self:
+                    stack.append(value)
+
+    def attach(self, node):
+        """ Tracks a detached `node` again when it is added back
+        to the structure, including any changes made to it while
+        it was detached. """
+        node._tracker.handler = self
+        node._tracker.frozen = None
+        if self.lazy or self.lazy_loading:
+            lazy_class = lazy_wrapper_for(type(node))
+            if lazy_class is not type(node):
+                set_class(node, lazy_class)
+        self.make_updates(node)
+
+    def child(self, node, key, value):
+        """ Returns the value read from `key` of a tracked node.
+
+        In lazy mode, a value that should be tracked is wrapped
+        and replaced in the node on first access. A `LazyLoadMarker`
+        is replaced with the value loaded from the persistence. """
+        if type(value) is LazyLoadMarker:
+            return self.load(key, node, value)
+        if self.resident is not None:
+            self.resident.touch(node, key)
+        if not self.lazy or istracked(value) or not self.should_upgrade(value):
+            return value
+        with self.lock:
+            subject = node.__subject__
+            items = self.get_items(subject, [key])
+            if not items:
+                return value
+            current = items[0][1]
+            if current is not value:
+                return self.child(node, key, current)
+            if self.copy_on_wrap:
+                tracked = self.start_to_track(copy.copy(value), node, key)
+                tracked._tracker.frozen = value
+            else:
+                tracked = self.start_to_track(value, node, key)
+            self.set_value(subject, key, value, tracked)
+        return tracked
+
+    def restore(self, contents):
+        """ Restores the whole structure to `contents`, e.g. a snapshot,
+        without change notifications.
+
+        Tracked containers are updated in place, so that references to
+        them stay valid. A container is matched with the contents that
+        were frozen from it, or else with the contents at the same key,
+        and containers whose frozen copy is the contents are unchanged
+        and skipped. Other values are replaced with copies. """
+        with self.lock:
+            shallow = self.lazy and self.copy_on_wrap
+            memo = {}
+            missing = object()
+            stack = [(self.root, contents)]
+            while stack:
+                node, contents = stack.pop()
+                if node._tracker.frozen is contents:
+                    continue
+                subject = node.__subject__
+                if isinstance(subject, MutableSet):
+                    if subject != contents:
+                        subject.clear()
+                        subject.update(contents)
+                        self.make_updates(node)
+                    continue
+                current = self.get_iterable(subject)
+                by_frozen = {
+                    id(value._tracker.frozen): value
+                    for key, value in current
+                    if istracked(value) and value._tracker.frozen is not None
+                }
+                current = dict(current)
+                kept = set()
+                items = []
+                changed = False
+                for key, value in self.get_iterable(contents):
+                    old = by_frozen.get(id(value))
+                    if old is None or id(old) in kept:
+                        old = current.get(key, missing)
+                    if old is value:
+                        pass
+                    elif (
+                        istracked(old) and id(old) not in kept
+                        and type(old.__subject__) is type(value)
+                    ):
+                        stack.append((old, value))
+                    elif (
+                        old is not missing and not istracked(old)
+                        and type(old) is type(value)
+                        and self.trackable_types.wrapper_for(value) is None
+                        and old == value
+                    ):
+                        pass
+                    else:
+                        old = value if shallow else copy.deepcopy(value, memo)
+                    if istracked(old):
+                        kept.add(id(old))
+                    if current.get(key, missing) is not old:
+                        changed = True
+                    items.append((key, old))
+                if len(items) != len(current):
+                    changed = True
+                if not changed:
+                    continue
+                replaced = [
+                    value for value in current.values()
+                    if istracked(value) and id(value) not in kept
+                ]
+                if isinstance(subject, MutableSequence):
+                    subject[:] = [value for key, value in items]
+                elif isinstance(subject, MutableMapping):
+                    subject.clear()
+                    subject.update(items)
+                elif object_fields(subject.__class__) is not None:
+                    values = dict(items)
+                    for key in object_fields(subject.__class__):
+                        if key in values:
+                            object.__setattr__(subject, key, values[key])
+                        elif hasattr(subject, key):
+                            object.__delattr__(subject, key)
+                else:
+                    subject.__dict__.clear()
+                    subject.__dict__.update(items)
+                if replaced:
+                    self.detach_removed(node, replaced, None)
+                self.make_updates(node)
+            if self.journaling:
+                self.persist.dump(self.root, self, initial=True)
+
+    def snapshot(self, node=None):
+        """ Returns the contents of the tracked `node`, or of the
+        whole structure, as plain dicts, lists, sets and objects.
+
+        Snapshots share the containers that have not changed between
+        them. Taking a snapshot only copies the containers changed
+        since the previous one, and there is nothing to copy if there
+        were no changes. In lazy mode, containers that have not been
+        read yet are not wrapped, and are shared with the structure
+        as they are. They are copied before they are changed through
+        the structure, so later changes do not show in the snapshot,
+        but changing the snapshot would change the structure without
+        tracking. Snapshots must therefore be treated as read-only. """
+        with self.lock:
+            self.copy_on_wrap = True
+            return self.freeze(self.root if node is None else node)
+
+    def freeze(self, node):
+        """ Returns the plain copy of the tracked `node`, reusing the
+        copies of the nodes that have not changed. The structure is
+        walked with an explicit stack, so that deep structures do not
+        hit the recursion limit. """
+        root = node
+        if root._tracker.frozen is not None:
+            return root._tracker.frozen
+        stack = [root]
+        # Copies waiting for the contained nodes to be frozen, with the
+        # keys and the nodes to fill in
+        unfinished = {}
+        while stack:
+            node = stack.pop()
+            tracker = node._tracker
+            if tracker.frozen is not None:
+                continue
+            if unfinished:
+                waiting = unfinished.pop(id(node), None)
+                if waiting is not None:
+                    frozen, pending = waiting
+                    if type(frozen) is list or type(frozen) is dict:
+                        for key, value in pending:
+                            frozen[key] = value._tracker.frozen
+                    else:
+                        for key, value in pending:
+                            self.set_value(
+                                frozen, key, value, value._tracker.frozen)
+                    tracker.frozen = frozen
+                    continue
+            subject = node.__subject__
+            pending = []
+            if type(subject) is list:
+                frozen = []
+                append = frozen.append
+                for value in node if self.lazy_loading else subject:
+                    if issubclass(type(value), TrackerWrapper):
+                        if value._tracker.frozen is None:
+                            pending.append((len(frozen), value))
+                        value = value._tracker.frozen
+                    append(value)
+            elif type(subject) is dict:
+                frozen = {}
+                for key, value in (
+                    node.items() if self.lazy_loading else subject.items()
+                ):
+                    if issubclass(type(value), TrackerWrapper):
+                        if value._tracker.frozen is None:
+                            pending.append((key, value))
+                        value = value._tracker.frozen
+                    frozen[key] = value
+            else:
+                frozen = copy.copy(subject)
+                for key, value in self.get_iterable(subject):
+                    if istracked(value):
+                        if value._tracker.frozen is None:
+                            pending.append((key, value))
+                        else:
+                            self.set_value(
+                                frozen, key, value, value._tracker.frozen)
+            if pending:
+                unfinished[id(node)] = (frozen, pending)
+                stack.append(node)
+                stack.extend(value for key, value in pending)
+            else:
+                tracker.frozen = frozen
+        return root._tracker.frozen
 
-        raise TypeError("Not a trackable or hashable type: " + str(contained))
+    def should_upgrade(self, contained):
+        return self.trackable_types.wrapper_for(contained) is not None
 
     def get_iterable(self, obj):
         """ Returns a (key, value) iterator regardless of object type. """
@@ -294,44 +864,117 @@ class Handler:
             return list(obj.items())
         elif isinstance(obj, MutableSet):
             return [(value, value) for value in obj]
+        elif object_fields(obj.__class__) is not None:
+            return self.get_items(obj, object_fields(obj.__class__))
         elif hasattr(obj, "__dict__"):
             return list(obj.__dict__.items())
         else:
             raise TypeError("Cannot return an iterator for type " + 
             str(type(obj)))
 
+    def get_items(self, obj, keys):
+        """ Returns a (key, value) iterator for the given keys, skipping
+        keys that are no longer present in the object. """
+        if isinstance(obj, MutableSequence):
+            return [(key, obj[key]) for key in keys if key < len(obj)]
+        elif isinstance(obj, MutableMapping):
+            return [(key, obj[key]) for key in keys if key in obj]
+        elif isinstance(obj, MutableSet):
+            return [(key, key) for key in keys if key in obj]
+        elif object_fields(obj.__class__) is not None:
+            return [
+                (key, getattr(obj, key)) for key in keys if hasattr(obj, key)
+            ]
+        elif hasattr(obj, "__dict__"):
+            return [(key, obj.__dict__[key]) for key in keys if key in obj.__dict__]
+        else:
+            raise TypeError("Cannot return an iterator for type " + 
+            str(type(obj)))
+
     def set_value(self, obj, key, old_value, new_value):
         if isinstance(obj, MutableSequence) or isinstance(obj, MutableMapping):
             obj[key] = new_value
         elif isinstance(obj, MutableSet):
             obj.remove(old_value)
             obj.add(new_value)
-        elif hasattr(obj, "__dict__"):
-            object.setattr(obj, key, new_value)
+        elif hasattr(obj, "__dict__") or object_fields(obj.__class__) is not None:
+            object.__setattr__(obj, key, new_value)
         else:
             raise TypeError("Cannot set value for type " + str(type(obj)))
 
     def get_value(self, obj, key):
-        if isinstance(obj, MutableSet):
+        if type(obj) in item_access_types:
+            return obj[key]
+        elif isinstance(obj, MutableSet):
             return key
-        elif isinstance(key, str) and hasattr(obj, key):
-            return getattr(obj, key)
-        else:
+        elif isinstance(obj, (MutableMapping, MutableSequence)):
             return obj[key]
+        else:
+            return getattr(obj, key)
 
     def at(self, path):
-        current = self.root
-        for key in path:
-            current = self.get_value(current, key)
-        return current
+        """ Returns the value at `path`.
+
+        Tracked containers found along the way are cached in
+        `path_cache`, a tree of `(node, children)` entries keyed
+        by path components, so that resolving the same paths again
+        is a dict lookup per step. Entries are dropped by
+        `make_updates` when the keys they go through change.
+
+        With a `ReadWriteLock`, the read side is taken, so that
+        lookups from several threads do not wait for each other. """
+        lock = self.lock
+        if lock.shared:
+            lock.acquire_read()
+            release = lock.release_read
+        else:
+            lock.acquire()
+            release = lock.release
+        try:
+            current = self.root
+            cache = self.path_cache
+            for key in path:
+                entry = cache.get(key) if cache is not None else None
+                if entry is not None:
+                    current, cache = entry
+                    continue
+                current = self.get_value(current, key)
+                if cache is not None and istracked(current):
+                    # Readers may race to add the same entry
+                    cache = cache.setdefault(key, (current, {}))[1]
+                else:
+                    cache = None
+            return current
+        finally:
+            release()
+
+    def forget_paths(self, node, keys):
+        """ Drops cached paths that go through the changed `keys` of
+        `node`, or through any of its contents if keys is None. For
+        lists, all indexes from the start of the change on, as well as
+        negative indexes, are dropped, as the values may have moved. """
+        cache = self.path_cache
+        for key in node._tracker.path[len(self.path_prefix):]:
+            entry = cache.get(key)
+            if entry is None:
+                return
+            cache = entry[1]
+        if keys is None:
+            cache.clear()
+        elif isinstance(keys, range):
+            for key in [
+                key for key in cache if key >= keys.start or key < 0
+            ]:
+                del cache[key]
+        else:
+            for key in keys:
+                cache.pop(key, None)
 
     def set(self, path, value):
         assert isinstance(path, list)
         if len(path) == 0:
             raise ValueError("Empty path, cannot set root")
-        current = self.root
-        for key in path[:-1]:
-            current = self.get_value(current, key)
+        current = self.at(path[:-1])
         key = path[-1]
         old_value = self.get_value(current, key)
         self.set_value(current, path[-1], old_value, value)
@@ -357,6 +1000,10 @@ class Handler:
         self.root = root
         return new_me
 
+# Registered after the write-behind workers, so that it
+# runs before them and the flushed changes get written
+atexit.register(Handler.flush_all)
+
 '''
 class ChangePathItem(dict):
     "Class to enable adding a change ID to change path items."
@@ -401,29 +1048,162 @@ def istracked(obj):
     return issubclass(type(obj), TrackerWrapper)
 
 
+class Subscriptions(dict):
+    """ Trie of change subscriptions, keyed on path segments.
+    Each node holds the callbacks subscribed to the path leading
+    to it, so that finding the subscribers for a change only
+    visits the nodes along the changed path. """
+
+    def __init__(self):
+        super().__init__()
+        self.callbacks = []
+
+    def add(self, path, callback):
+        node = self
+        for key in path:
+            node = node.setdefault(key, Subscriptions())
+        node.callbacks.append(callback)
+
+    def remove(self, path, callback):
+        nodes = [self]
+        try:
+            for key in path:
+                nodes.append(nodes[-1][key])
+            nodes[-1].callbacks.remove(callback)
+        except (KeyError, ValueError):
+            raise ValueError(
+                "%s is not subscribed to %s" % (callback, path)) from None
+        for key, parent, node in reversed(list(zip(path, nodes, nodes[1:]))):
+            if node or node.callbacks:
+                break
+            del parent[key]
+
+    def matching(self, path, keys=None):
+        """ Returns the callbacks subscribed to the changed `path`
+        or its parents, and to the changed `keys` under it and their
+        contents. If `keys` is None, all the contents under the path
+        are considered changed. """
+        node = self
+        found = list(node.callbacks)
+        for key in path:
+            node = node.get(key)
+            if node is None:
+                return found
+            found.extend(node.callbacks)
+        if keys is None:
+            for child in node.values():
+                found.extend(child.all_callbacks())
+        else:
+            for key in keys:
+                child = node.get(key)
+                if child is not None:
+                    found.extend(child.all_callbacks())
+        return found
+
+    def all_callbacks(self):
+        yield from self.callbacks
+        for child in self.values():
+            yield from child.all_callbacks()
+
+
 class History(list):
-    
-    def __init__(self, handler, capacity):
+    """ List of history entries, latest first.
+    Each entry is a list of `Operation` records, applied
+    in reverse to undo, and in order to redo the entry.
+
+    Besides the `capacity` in entries, history can be limited
+    with a memory `budget` in bytes. The size of each entry is
+    estimated when it is added, and the oldest entries are
+    dropped when the total goes over the budget. If
+    `compress_after` is set, entries older than that many
+    entries are kept serialized and compressed.
+
+    `bytes` is the estimated total size of the entries, and
+    `evictions` the number of entries dropped to stay within
+    the capacity or the budget. The contents of uncompressed
+    entries are only measured while a budget is set.
+
+    Each entry has a `version` number, increasing with every
+    new entry. If `checkpoint_every` is set, every that many
+    entries also keep a snapshot of the whole structure as a
+    checkpoint, which `goto` uses to jump to distant versions.
+    Checkpoints share unchanged contents with each other and
+    are not counted in `bytes`. Entries are then also serialized
+    when they are created, so that the values they write onto a
+    restored checkpoint are those at the time of the change. """
+
+    budget = 0
+    compress_after = None
+    checkpoint_every = 0
+
+    def __init__(self, handler, capacity,
+            budget=None, compress_after=None, checkpoint_every=None):
         super().__init__()
         self.handler = handler
         self.capacity = capacity
+        if budget is not None:
+            self.budget = budget
+        if compress_after is not None:
+            self.compress_after = compress_after
+        if checkpoint_every is not None:
+            self.checkpoint_every = checkpoint_every
         self.active = 0
-        
-    def new_entry(self, delta):
+        self.bytes = 0
+        self.evictions = 0
+        self.latest_version = 0
+        self.by_path = False
+
+    @property
+    def entries(self):
+        return len(self)
+
+    def new_entry(self, operations):
+        for entry in self[:self.active]:
+            self.bytes -= entry.size
         del self[:self.active]
-        self.insert(0, delta)
+        entry = HistoryEntry(operations, serialize=(
+            self.compress_after is not None or self.checkpoint_every > 0),
+            measure=self.budget > 0)
+        self.latest_version += 1
+        entry.version = self.latest_version
+        if self.checkpoint_every > 0 and not any(
+            older.checkpoint is not None
+            for older in self[:self.checkpoint_every - 1]
+        ):
+            entry.checkpoint = self.handler.snapshot()
+        self.insert(0, entry)
+        self.bytes += entry.size
         self.active = 0
-        if self.capacity > 0:
-            del self[self.capacity:]
-        
+        if self.compress_after is not None and len(self) > self.compress_after:
+            older = self[self.compress_after]
+            if isinstance(older, HistoryEntry) and older.serialized is not None:
+                self[self.compress_after] = CompressedEntry(older)
+                self.bytes += self[self.compress_after].size - older.size
+        while len(self) > 0 and (
+            self.capacity > 0 and len(self) > self.capacity
+            or self.budget > 0 and self.bytes > self.budget
+        ):
+            self.bytes -= self.pop().size
+            self.evictions += 1
+
+    def operations(self, index):
+        """ Returns the operations of the entry at `index`, and the
+        handler to apply them with if targets are looked up by path. """
+        entry = self[index]
+        if isinstance(entry, CompressedEntry):
+            return entry.operations(), self.handler
+        if self.by_path and entry.serialized is not None:
+            return load_operations(entry.serialized), self.handler
+        by_path = self.by_path or self.compress_after is not None
+        return entry, self.handler if by_path else None
+
     def undo(self):
         if self.active + 1 >= len(self):
             return self.active
-        delta = self[self.active]
+        operations, handler = self.operations(self.active)
         with self.handler.root:
-            self.handler.track = False
-            dictdiffer.revert(delta, self.handler.root, in_place=True)
-            self.handler.track = True
+            for operation in reversed(operations):
+                operation.undo(handler)
         self.active += 1
         return self.active
         
@@ -431,26 +1211,188 @@ class History(list):
         if self.active == 0:
             return self.active
         self.active -= 1
-        delta = self[self.active]
+        operations, handler = self.operations(self.active)
         with self.handler.root:
-            self.handler.track = False
-            dictdiffer.patch(delta, self.handler.root, in_place=True)
-            self.handler.track = True
+            for operation in operations:
+                operation.redo(handler)
         return self.active
 
+    def goto(self, version):
+        """ Moves to the state right after the entry with the given
+        `version`, undoing or redoing the entries in between.
+
+        If the entry is more than `checkpoint_every` entries away, and
+        a checkpoint is closer to it, the checkpoint is restored first,
+        and only the entries between the checkpoint and the version are
+        applied. Checkpoints are only used if all of those entries are
+        serialized. The checkpoint is restored in place, see
+        `Handler.restore`, so references to containers kept across
+        `goto` stay tracked, except for those created after the
+        checkpoint, which are created again when entries are applied. """
+        for index, entry in enumerate(self):
+            if entry.version == version:
+                break
+        else:
+            raise ValueError('No version %s in history' % version)
+        with self.handler.root:
+            distance = abs(index - self.active)
+            if self.checkpoint_every > 0 and distance > self.checkpoint_every:
+                closest = min(
+                    (i for i, entry in enumerate(self)
+                    if entry.checkpoint is not None
+                    and self.replayable(i, index)),
+                    key=lambda i: abs(i - index),
+                    default=None,
+                )
+                if closest is not None and abs(closest - index) < distance:
+                    self.handler.restore(self[closest].checkpoint)
+                    self.active = closest
+                    self.by_path = True
+            while self.active < index:
+                self.undo()
+            while self.active > index:
+                self.redo()
+        return self.active
+
+    def replayable(self, start, end):
+        """ True if the entries applied when moving from `start` to
+        `end` have their values as they were at the time of the change. """
+        entries = self[start:end] if start < end else self[end:start]
+        return all(
+            isinstance(entry, CompressedEntry) or entry.serialized is not None
+            for entry in entries
+        )
+
+
+class Resident(OrderedDict):
+    """ Values loaded lazily from the persistence, from the least to
+    the most recently used, keyed by the identity of the parent and the
+    key of the value. Sizes are estimated when the values are loaded,
+    and only if there is a limit on bytes. `evicted` holds weak
+    references to the evicted tracked values, with the same keys. """
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        super().__init__()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.evicted = weakref.WeakValueDictionary()
+
+    def add(self, parent, key, storage_key, value):
+        size = estimate_size(value) if self.max_bytes is not None else 0
+        self[(id(parent), key)] = (parent, key, storage_key, value, size)
+        self.bytes += size
+
+    def touch(self, parent, key):
+        """ Marks the value at `key` of `parent` as used, if loaded. """
+        try:
+            self.move_to_end((id(parent), key))
+        except KeyError:
+            pass
+
+    def pop_oldest(self):
+        _, (parent, key, storage_key, value, size) = self.popitem(last=False)
+        self.bytes -= size
+        return parent, key, storage_key, value
+
+    def over_limit(self):
+        return (
+            self.max_entries is not None and len(self) > self.max_entries
+            or self.max_bytes is not None and self.bytes > self.max_bytes
+        )
+
+
+class HistoryEntry(list):
+    """ Operations of one history entry, with the estimated
+    `size` of the entry in bytes. The operations are only
+    measured with `measure`, otherwise `size` is that of the
+    serialized operations, if any.
+
+    With `serialize`, the operations are also serialized when
+    the entry is created, to have the values as they were at
+    the time of the change when the entry is compressed. If
+    the values cannot be serialized, `serialized` is None, and
+    the entry is kept as it is. """
+
+    version = None
+    checkpoint = None
+
+    def __init__(self, operations, serialize=False, measure=True):
+        super().__init__(operations)
+        self.serialized = None
+        if serialize:
+            try:
+                self.serialized = dump_operations(self)
+            except (pickle.PicklingError, TypeError, AttributeError):
+                pass
+        self.size = len(self.serialized or b'')
+        if measure:
+            self.size += estimate_size([
+                (operation.old, operation.new) for operation in self
+            ])
+
+
+class CompressedEntry:
+    """ History entry kept as compressed, serialized operations. """
+
+    def __init__(self, entry):
+        self.version = entry.version
+        self.checkpoint = entry.checkpoint
+        self.data = zlib.compress(entry.serialized)
+        self.size = getsizeof(self) + len(self.data)
+
+    def operations(self):
+        return load_operations(zlib.decompress(self.data))
+
+    def __len__(self):
+        return len(self.operations())
+
+    def __getitem__(self, index):
+        return self.operations()[index]
+
+
+def snapshot(tracked):
+    """ Returns a snapshot of the contents of the tracked
+    structure, to be treated as read-only, see `Handler.snapshot`. """
+    return handler(tracked).snapshot(tracked)
+
 def deepcopy_tracked(obj):
+    """ Returns a new tracked copy of the tracked object.
+
+    In lazy mode, the copy starts out sharing its contents with
+    a snapshot of the object, and contained values are copied
+    when they are first accessed. """
     if not istracked(obj):
         raise TypeError("Cannot copy a non-tracked type: " + str(type(obj)))
-    content = copy.deepcopy(obj)
-    return _track_and_copy_meta(content, obj)
+    return _track_and_copy_meta(snapshot(obj), obj)
 
 
 def _track_and_copy_meta(content, source_tracker):
+    """ Tracks a copy of `content`, a snapshot of the tracked source,
+    with the options of the source. In lazy mode, the contents are
+    copied when first accessed, otherwise all at once. The copy does
+    not share the persistence or the history entries of the source. """
     old_handler = source_tracker._tracker.handler
-    tracked = track(content, old_handler.name)
+    old_history = old_handler.history
+    tracked = track(
+        copy.copy(content) if old_handler.lazy else copy.deepcopy(content),
+        old_handler.name,
+        persist=False,
+        change_callback=old_handler.change_callback,
+        history=old_history is not None and (old_history.capacity or True),
+        conflict_callback=old_handler.conflict_callback,
+        path_prefix=list(old_handler.path_prefix),
+        dot_access=(
+            old_handler.trackable_types.get(MutableMapping) is DictWrapper_Dot),
+        lazy=old_handler.lazy,
+        read_write_lock=old_handler.lock.shared,
+        coalesce=old_handler.coalesce,
+    )
     new_handler = tracked._tracker.handler
-    new_handler.change_paths = copy.deepcopy(old_handler.change_paths)
-    new_handler.callback = old_handler.callback
+    new_handler.copy_on_wrap = old_handler.lazy
+    if old_history is not None:
+        for option in ('budget', 'compress_after', 'checkpoint_every'):
+            setattr(new_handler.history, option, getattr(old_history, option))
     return tracked
 
 '''
@@ -2,13 +2,17 @@
 
 import json
 import importlib
-from collections.abc import MutableMapping
+import os, re, struct, pickle, functools, atexit, weakref
+from collections import Counter
+from collections.abc import Mapping, MutableMapping, MutableSequence
 from contextlib import contextmanager
 from copy import deepcopy
+from threading import Thread, RLock, Condition, get_ident
 
 import dictdiffer
 
 from tinysync.util import *
+from tinysync.wrappers import dump_operations, load_operations
 
 @contextmanager
 def do_not_track(obj):
@@ -26,6 +30,10 @@ def do_not_save(obj):
 
 class Persistence():
   
+  journaling = False
+  snapshot_dumps = False
+  lazy_loading = False
+  
   def load(self):
     """Load whole structure from persistence provider."""
     
@@ -35,17 +43,24 @@ class Persistence():
   def change_advisory(self, change):
     """Information about a change."""
     
+  def record(self, operation):
+    """Record of a single change, passed at the time of the change if `journaling` is True. The operation has no target, and its `location` is relative to the root of the structure."""
+    
   def dump(to_save, handler, conflict_callback, initial=False):
     """Persist the given structure.
     Initial save may be different in some cases.
     
     Returns a list of conflicts from the persistence layer or None if no conflicts.
-    Conflicts are reported as a list of (path, new value) tuples. """
+    Conflicts are reported as a list of (path, new value) tuples.
+    
+    If `snapshot_dumps` is True, dump only reads the structure, and can be given a snapshot of it instead of the tracked structure. """
     
 
 class AbstractFile(Persistence):
   
   file_format = 'abstract'
+  binary = False
+  snapshot_dumps = True
   
   def __init__(self, filename):
     self.format = format if format else self.default_format
@@ -53,7 +68,10 @@ class AbstractFile(Persistence):
     
   def load(self):
     try:
-      with open(self.filename, encoding='utf-8') as fp:
+      with (
+        open(self.filename, 'rb') if self.binary
+        else open(self.filename, encoding='utf-8')
+      ) as fp:
         return self.loader(fp)
     except (EOFError, FileNotFoundError):
       return None
@@ -65,10 +83,99 @@ class AbstractFile(Persistence):
     return self.load()
     
   def dump(self, to_save, handler=None, conflict_callback=None, initial=False):
-    with open(self.filename, 'w', encoding='utf-8') as fp:
+    with (
+      open(self.filename, 'wb') if self.binary
+      else open(self.filename, 'w', encoding='utf-8')
+    ) as fp:
       self.dumper(to_save, fp)
 
 
+class PersistenceWorker:
+  """ Writes the changes of a tracked structure to its persistence in a background thread, for the `write_behind` option of `track`.
+  
+  Change notifications are queued, and all the changes queued while the previous write was in progress are written with a single dump (group commit). `flush` waits until the queued changes have been written, and is also called when the interpreter exits.
+  
+  The thread is started when changes are queued, and exits when there is nothing left to write, so that idle workers do not keep threads, or their structures, alive.
+  
+  If the persistence has `snapshot_dumps`, it is given a snapshot of the structure, taken under the lock, so that changes made during the write do not wait for it. Otherwise the structure is dumped under the lock.
+  """
+  
+  # Workers of the structures still in use, flushed at exit
+  workers = weakref.WeakSet()
+  
+  def __init__(self, handler):
+    self.handler = handler
+    self.queue = []
+    self.writing = False
+    self.error = None
+    self.condition = Condition()
+    self.thread = None
+    self.workers.add(self)
+    
+  def add(self, change, save=True):
+    """ Queues a change notification, to be passed to the persistence and, if `save` is True, dumped. """
+    with self.condition:
+      self.queue.append((change, save))
+      if self.thread is None:
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+      
+  def flush(self):
+    """ Returns when all the queued changes have been written. Raises the error of a failed write, if any. If called while holding the lock of the structure, the queued changes are written in the calling thread. """
+    if self.handler.lock.writer == get_ident():
+      with self.condition:
+        queue, self.queue = self.queue, []
+      if queue:
+        self.write(queue)
+    else:
+      with self.condition:
+        while self.queue or self.writing:
+          self.condition.wait()
+    with self.condition:
+      error, self.error = self.error, None
+    if error is not None:
+      raise error
+    
+  def run(self):
+    while True:
+      with self.condition:
+        queue, self.queue = self.queue, []
+        self.writing = True
+      try:
+        self.write(queue)
+      except Exception as error:
+        self.error = error
+      with self.condition:
+        self.writing = False
+        self.condition.notify_all()
+        if not self.queue:
+          self.thread = None
+          return
+          
+  def write(self, queue):
+    handler = self.handler
+    persist = handler.persist
+    if persist is None:
+      return
+    with handler.lock:
+      for change, save in queue:
+        persist.change_advisory(change)
+      if not any(save for change, save in queue):
+        return
+      if not persist.snapshot_dumps:
+        persist.dump(handler.root, handler, handler.conflict_callback)
+        return
+      contents = handler.snapshot()
+    persist.dump(contents, handler, handler.conflict_callback)
+    
+  @classmethod
+  def flush_all(cls):
+    for worker in list(cls.workers):
+      worker.flush()
+
+atexit.register(PersistenceWorker.flush_all)
+
+
 class SafeYamlFile(AbstractFile):
   
   file_format = 'yaml'
@@ -78,21 +185,260 @@ class SafeYamlFile(AbstractFile):
     globals()['yaml'] = importlib.import_module('yaml')
       
   def loader(self, fp):
-    return yaml.safe_load(fp)
+    return yaml.load(fp, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
       
   def dumper(self, to_save, fp):
-    
-    class TrackerSafeDumper(yaml.SafeDumper):
-      def represent_data(self, data):
-        if hasattr(data, '__subject__'):
-          data = data.__subject__
-        return super().represent_data(data)
-    
     yaml.dump(
       to_save, fp,
       default_flow_style=False,
       allow_unicode=True,
-      Dumper=TrackerSafeDumper)
+      Dumper=tracker_dumper(getattr(yaml, 'CSafeDumper', yaml.SafeDumper)))
+
+
+def plain(obj):
+  """ Fallback for serializers that do not know tracked objects or sets: returns the wrapped object, or the members of a set as a list. """
+  if hasattr(obj, '__subject__'):
+    return obj.__subject__
+  if isinstance(obj, (set, frozenset)):
+    return list(obj)
+  raise TypeError('Object of type %s is not serializable' % type(obj).__name__)
+
+
+class JsonFile(AbstractFile):
+  """ Stores the structure as JSON. Uses `orjson` if it is installed, and the standard library `json` module otherwise.
+  
+  Sets are stored as lists, and dict keys as strings. """
+  
+  file_format = 'json'
+  binary = True
+  
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    try:
+      self.orjson = importlib.import_module('orjson')
+    except ImportError:
+      self.orjson = None
+      
+  def loader(self, fp):
+    if self.orjson is not None:
+      return self.orjson.loads(fp.read())
+    return json.load(fp)
+    
+  def dumper(self, to_save, fp):
+    if self.orjson is not None:
+      fp.write(self.orjson.dumps(
+        to_save, default=plain, option=self.orjson.OPT_NON_STR_KEYS))
+    else:
+      fp.write(json.dumps(
+        to_save, default=plain, ensure_ascii=False).encode('utf-8'))
+
+
+class MsgpackFile(AbstractFile):
+  """ Stores the structure as MessagePack, using the `msgpack` package.
+  
+  Sets and tuples are stored as lists. """
+  
+  file_format = 'msgpack'
+  binary = True
+  
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    globals()['msgpack'] = importlib.import_module('msgpack')
+    
+  def loader(self, fp):
+    return msgpack.unpack(fp, raw=False, strict_map_key=False)
+    
+  def dumper(self, to_save, fp):
+    msgpack.pack(to_save, fp, default=plain, use_bin_type=True)
+
+
+class PickleFile(AbstractFile):
+  """ Stores the structure with `pickle`, which keeps sets, tuples and other objects as they are.
+  
+  Only load files you trust, as loading a pickle can run arbitrary code. """
+  
+  file_format = 'pickle'
+  binary = True
+  
+  def loader(self, fp):
+    return pickle.load(fp)
+    
+  def dumper(self, to_save, fp):
+    pickle.dump(to_save, fp, pickle.HIGHEST_PROTOCOL)
+
+
+@functools.lru_cache(maxsize=None)
+def tracker_dumper(dumper_class):
+  """ Returns a subclass of the given YAML dumper class that dumps tracked objects as the objects they wrap. Created once per dumper class. """
+  
+  class TrackerDumper(dumper_class):
+    def represent_data(self, data):
+      if hasattr(data, '__subject__'):
+        data = data.__subject__
+      return super().represent_data(data)
+  
+  TrackerDumper.__name__ = 'Tracker' + dumper_class.__name__
+  return TrackerDumper
+
+
+def resolve_path(data, path):
+  """ Returns the value at `path` in a plain structure. """
+  for key in path:
+    if isinstance(data, (MutableMapping, MutableSequence)):
+      data = data[key]
+    else:
+      data = getattr(data, key)
+  return data
+
+
+class JournalFile(Persistence):
+  """ Persistence that appends each change to a log file as the change is made, so that the cost of a write is proportional to the size of the change rather than the size of the whole structure.
+  
+  The structure is stored as a pickled snapshot, `<name>.snapshot`, and logs of the changes made after it, `<name>.<generation>.journal`. `load` replays the logs over the snapshot. Once the log grows past `compact_after` bytes, a new generation of the log is started and a fresh snapshot is written in a background thread, after which the older logs are removed.
+  
+  A record that was only partially written, e.g. due to a crash, is dropped on load.
+  """
+  
+  journaling = True
+  compact_after = 16 * 1024 * 1024
+  
+  def __init__(self, filename, compact_after=None):
+    self.filename = filename
+    if compact_after is not None:
+      self.compact_after = compact_after
+    self.generation = None
+    self.log = None
+    self.lock = RLock()
+    self.compaction = None
+    
+  def snapshot_name(self):
+    return self.filename + '.snapshot'
+    
+  def log_name(self, generation):
+    return '%s.%d.journal' % (self.filename, generation)
+    
+  def generations(self):
+    """ Returns the generations of the existing log files in order. """
+    directory, base = os.path.split(self.filename)
+    pattern = re.compile(re.escape(base) + r'\.(\d+)\.journal$')
+    return sorted(
+      int(match.group(1))
+      for match in map(pattern.match, os.listdir(directory or '.'))
+      if match
+    )
+    
+  def load(self):
+    try:
+      with open(self.snapshot_name(), 'rb') as fp:
+        generation, data = pickle.load(fp)
+    except (EOFError, FileNotFoundError):
+      return None
+    self.generation = generation
+    for log_generation in self.generations():
+      if log_generation < generation:
+        os.remove(self.log_name(log_generation))
+        continue
+      self.generation = log_generation
+      for operation in self.read_log(log_generation):
+        operation.write(
+          resolve_path(data, operation.location),
+          operation.new, operation.old)
+    return data
+    
+  def load_specific(self, key):
+    """ Identical to calling load(), as for file-based persistence. """
+    return self.load()
+    
+  def read_log(self, generation):
+    """ Returns the operations recorded in the log of the given generation. A partially written record at the end of the log is truncated away. """
+    name = self.log_name(generation)
+    with open(name, 'rb') as fp:
+      content = fp.read()
+    operations = []
+    position = 0
+    while position + 4 <= len(content):
+      (size,) = struct.unpack_from('<I', content, position)
+      if position + 4 + size > len(content):
+        break
+      operations.extend(
+        load_operations(content[position + 4:position + 4 + size]))
+      position += 4 + size
+    if position < len(content):
+      with open(name, 'r+b') as fp:
+        fp.truncate(position)
+    return operations
+    
+  def record(self, operation):
+    data = dump_operations([operation])
+    with self.lock:
+      if self.generation is None:
+        return
+      if self.log is None:
+        self.log = open(self.log_name(self.generation), 'ab')
+      self.log.write(struct.pack('<I', len(data)))
+      self.log.write(data)
+      
+  def dump(self, to_save, handler=None, conflict_callback=None, initial=False):
+    """ Writes the recorded changes to the log. On the first dump, or if `initial` is set, a snapshot of the whole structure is written instead. """
+    if initial or self.generation is None:
+      self.compact(to_save, handler, background=False)
+      return
+    with self.lock:
+      if self.log is None:
+        return
+      self.log.flush()
+      size = self.log.tell()
+    if size > self.compact_after and self.compaction is None:
+      self.compact(to_save, handler)
+      
+  def compact(self, to_save, handler=None, background=True):
+    """ Starts a new generation of the log, and writes a snapshot of the structure that replaces the older logs. With a handler, the snapshot is taken under the lock of the handler, so that it matches the point where the new log starts, and only written to file in the background. """
+    if handler is not None:
+      with handler.lock:
+        contents = handler.snapshot()
+        generation = self.next_generation()
+    else:
+      contents = to_save
+      generation = self.next_generation()
+      background = False
+    if background:
+      self.compaction = Thread(
+        target=self.write_snapshot, args=(generation, contents),
+        daemon=True)
+      self.compaction.start()
+    else:
+      self.write_snapshot(generation, contents)
+      
+  def next_generation(self):
+    with self.lock:
+      if self.log is not None:
+        self.log.close()
+        self.log = None
+      self.generation = (
+        0 if self.generation is None else self.generation + 1)
+      return self.generation
+    
+  def write_snapshot(self, generation, contents):
+    try:
+      temporary = self.snapshot_name() + '.tmp'
+      with open(temporary, 'wb') as fp:
+        pickle.dump((generation, contents), fp, pickle.HIGHEST_PROTOCOL)
+      os.replace(temporary, self.snapshot_name())
+      for log_generation in self.generations():
+        if log_generation < generation:
+          os.remove(self.log_name(log_generation))
+    finally:
+      self.compaction = None
+      
+  def close(self):
+    """ Waits for a running compaction and closes the log. """
+    compaction = self.compaction
+    if compaction is not None:
+      compaction.join()
+    with self.lock:
+      if self.log is not None:
+        self.log.close()
+        self.log = None
 
 
 class LazyPersistence(Persistence):
@@ -104,54 +450,192 @@ class LazyPersistence(Persistence):
   value to be used in the other operations.
   """
   
+  lazy_loading = True
+  
   def __init__(self):
-    self.changed_keys = self.deleted_keys = set()
+    self.changed_keys = set()
+    self.deleted_keys = set()
     
   def change_advisory(self, change):
     assert hasattr(change.root, '__getitem__')
-    if len(change.path) == 0:
-      if change.func_name == '__setitem__':
-        self.changed_keys.add(change.args[0])
-      if change.func_name == '__delitem__':
-        self.deleted_keys.add(change.args[0])
-    else:
-      self.changed_keys.add(change.path[0])
+    for record in change.changes:
+      path = record.path
+      if len(path) > 0:
+        self.changed_keys.add(path[0])
+      elif record.region is None:
+        self.changed_keys.update(change.root.keys())
+        self.deleted_keys.update(
+          key for key in self.stored_keys() if key not in change.root)
+      else:
+        for key in record.region:
+          if key in change.root:
+            self.changed_keys.add(key)
+            self.deleted_keys.discard(key)
+          else:
+            self.deleted_keys.add(key)
+            self.changed_keys.discard(key)
+        
+  def stored_keys(self):
+    return [
+      key.decode() if isinstance(key, bytes) else key
+      for key in self.db
+    ]
 
 class JsonDBM(LazyPersistence):
+  """ Stores the structure in a DBM database as JSON, split into records, or shards, by key path.
   
-  def __init__(self, filename):
+  Nested dicts are split into separate records down to `depth` levels, and a change only rewrites the shard that contains it. With the default depth of 1, each value of the root dict is one record. On load, the values of the root dict are represented by `LazyLoadMarker`s, and only loaded when accessed. Dicts split into deeper shards are loaded one level at a time, with markers for the next level.
+  
+  `flag` is passed to `dbm.open`. The default 'n' always starts with an empty database, use 'c' to load an existing one.
+  """
+  
+  def __init__(self, filename, depth=1, flag='n'):
     super().__init__()
     globals()['dbm'] = importlib.import_module('dbm')
     self.filename = filename + '.dbm'
-    self.db = dbm.open(self.filename, 'n')
+    self.depth = depth
+    self.db = dbm.open(self.filename, flag)
+    self.stored = set()
+    self.segments = {}
+    for key in self.db.keys():
+      self.add_stored(self.decode(key))
   
   def __del__(self):
     self.db.close()
+    
+  @staticmethod
+  def encode(path):
+    """ Database key of the shard at `path`. Top-level keys are used as they are. """
+    if len(path) == 1:
+      return path[0]
+    return '\x00' + json.dumps(list(path))
+    
+  @staticmethod
+  def decode(key):
+    if isinstance(key, bytes):
+      key = key.decode()
+    if key.startswith('\x00'):
+      return tuple(json.loads(key[1:]))
+    return (key,)
   
+  def add_stored(self, path):
+    self.stored.add(path)
+    for i in range(len(path)):
+      self.segments.setdefault(path[:i], Counter())[path[i]] += 1
+      
+  def discard_stored(self, path):
+    if path not in self.stored:
+      return
+    self.stored.discard(path)
+    for i in range(len(path)):
+      counts = self.segments[path[:i]]
+      counts[path[i]] -= 1
+      if not counts[path[i]]:
+        del counts[path[i]]
+        if not counts:
+          del self.segments[path[:i]]
+    
+  def segment(self, path):
+    """ Dict at `path` that is split into deeper shards, with markers for its values. """
+    return {
+      key: LazyLoadMarker(path + (key,))
+      for key in self.segments.get(path, ())
+    }
+    
   def load(self):
-    try:
-      if len(self.db) == 0:
-        return None
-      return_value = {}
-      for key in self.db:
-        return_value[key.decode()] = LazyLoadMarker()
-      return return_value
-    except (EOFError, FileNotFoundError):
+    if not self.stored:
       return None
+    return self.segment(())
     
   def load_specific(self, key):
-    return json.loads(self.db[key].decode())
+    path = key if isinstance(key, tuple) else (key,)
+    if path not in self.stored:
+      return self.segment(path)
+    return json.loads(self.db[self.encode(path)].decode())
+    
+  def change_advisory(self, change):
+    for record in change.changes:
+      path = tuple(record.path)
+      keys = record.keys
+      if keys is None or len(path) >= self.depth:
+        self.changed_keys.add(path)
+      else:
+        self.changed_keys.update(path + (key,) for key in keys)
     
   def dump(self, to_save, handler=None, conflict_callback=None, initial=False):
     assert hasattr(to_save, '__getitem__')
-    if initial:
-      self.changed_keys = (key for key in to_save)       
-    for key in self.changed_keys:
-      self.db[key] = json.dumps(to_save[key])
-    self.changed_keys = set()
-    for key in self.deleted_keys:
-      del self.db[key]
-    self.deleted_keys = set()
+    if initial or not self.stored:
+      self.changed_keys = {()}
+    changed, self.changed_keys = self.changed_keys, set()
+    shards = {self.shard_of(to_save, path) for path in changed}
+    for shard in shards:
+      if not any(shard[:i] in shards for i in range(len(shard))):
+        self.rewrite(to_save, shard)
+        
+  def splits(self, path, value):
+    return (
+      len(path) < self.depth
+      and isinstance(value, Mapping)
+      and (len(value) > 0 or len(path) == 0)
+    )
+    
+  def shard_of(self, root, path):
+    """ Returns the path of the shard that contains the value at `path`, or that contained it, if it was removed. """
+    value = root
+    for index, key in enumerate(path):
+      value = getattr(value, '__subject__', value)
+      if not self.splits(path[:index], value):
+        return path[:index]
+      if key not in value:
+        return path[:index + 1]
+      value = value[key]
+    return path
+    
+  def rewrite(self, root, shard):
+    """ Writes the shards at and below `shard` from the current contents, and removes the ones that are no longer there. Shards that have not been loaded are kept as they are. """
+    records = {}
+    kept = set()
+    value = root
+    for key in shard:
+      value = getattr(value, '__subject__', value)
+      if not isinstance(value, Mapping) or key not in value:
+        break
+      value = value[key]
+    else:
+      self.collect(shard, value, records, kept)
+    for path, value in records.items():
+      self.db[self.encode(path)] = json.dumps(value, default=plain)
+      self.add_stored(path)
+    # The shard itself, the shards that its ancestors were stored
+    # as, if any, and the shards below it, which there can only be
+    # if it is not at full depth
+    stale = [
+      shard[:i] for i in range(len(shard) + 1) if shard[:i] in self.stored
+    ]
+    if len(shard) < self.depth:
+      stale.extend(
+        path for path in self.stored
+        if len(path) > len(shard) and path[:len(shard)] == shard)
+    # Markers of split dicts keep the shards below them
+    stale = [
+      path for path in stale if path not in records
+      and not any(path[:i] in kept for i in range(1, len(path) + 1))]
+    for path in stale:
+      del self.db[self.encode(path)]
+      self.discard_stored(path)
+      
+  def collect(self, path, value, records, kept):
+    value = getattr(value, '__subject__', value)
+    if isinstance(value, LazyLoadMarker):
+      if value.key == path:
+        kept.add(path)
+        return
+      value = self.load_specific(value.key)
+    if self.splits(path, value):
+      for key, child in value.items():
+        self.collect(path + (key,), child, records, kept)
+    else:
+      records[path] = value
     
     
 class CouchDB(LazyPersistence):
@@ -178,6 +178,22 @@ class ObjectWrapper(ObjectProxy, AbstractWrapper):      __slots__ = ()
 class CallbackWrapper(CallbackProxy, AbstractWrapper):  __slots__ = ()
 class LazyWrapper(LazyProxy, AbstractWrapper):          __slots__ = ()
 
+class DirectWrapper(ObjectWrapper):
+  """Wrapper for a specific object that looks up attributes on the
+  wrapper first, without a Python-level __getattribute__ on every
+  access. Missing attributes are still delegated to the subject, and
+  the class of the subject is reported as the class of the wrapper."""
+  __slots__ = ()
+
+  __getattribute__ = object.__getattribute__
+
+  @property
+  def __class__(self):
+    return type(self.__subject__)
+
+  def __reduce_ex__(self, protocol):
+    return self.__subject__.__reduce_ex__(protocol)
+
 if __name__ == '__main__':
   p = ObjectProxy(42)
   assert p == 42
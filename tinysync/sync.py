@@ -142,10 +142,10 @@ class Sync(QueueControl):
 
         previous_value = dictdiffer.patch(
           add_to_baseline, state.baseline)
-        with self.content:
-            latest_edit = list(dictdiffer.diff(
-              previous_value, self.content))
-        latest_checksum = Sync.generate_checksum(self.content)
+        content = tinysync.snapshot(self.content)
+        latest_edit = copy.deepcopy(list(dictdiffer.diff(
+          previous_value, content)))
+        latest_checksum = Sync.generate_checksum(content)
         #edits.append((str(previous_version+1)+'-'+str(latest_checksum), latest_edit))
         if len(latest_edit) > 0:
             state.edits.append((latest_checksum, latest_edit))
@@ -194,7 +194,7 @@ class Sync(QueueControl):
             if remote_index == -1:
                 print('PROBLEM', state.edits, remote_edits)
     
-            content_at_start = copy.deepcopy(self.content)
+            content_at_start = tinysync.snapshot(self.content)
     
             if debugging:
                 print('local edits', state.edits)
@@ -278,8 +278,9 @@ class Sync(QueueControl):
     @staticmethod
     def generate_checksum(data):
         "Returns a hash of the JSON-serializable parameter"
-        copy_data = copy.deepcopy(data)
-        string_data = json.dumps(copy_data, sort_keys=True)
+        if tinysync.istracked(data):
+            data = tinysync.snapshot(data)
+        string_data = json.dumps(data, sort_keys=True)
         return hashlib.md5(string_data.encode()).hexdigest()
 
     @staticmethod
@@ -1,6 +1,7 @@
 #coding: utf-8
-from sys import stderr
-from threading import Thread
+from sys import stderr, getsizeof
+from types import FunctionType, MethodType, ModuleType
+from threading import Thread, RLock, Lock, Condition, get_ident
 from functools import wraps
 
 def run_async(func):
@@ -14,8 +15,152 @@ def run_async(func):
 def eprint(*args, **kwargs):
   print(*args, file=stderr, **kwargs)
 
+class WriteLock():
+  """Re-entrant lock that also tells which thread, if any, is holding it, so that readers can skip locking when there is no writer."""
+  
+  shared = False
+  
+  def __init__(self):
+    self._lock = RLock()
+    self.writer = None
+    self.depth = 0
+    
+  def acquire(self, blocking=True, timeout=-1):
+    acquired = self._lock.acquire(blocking, timeout)
+    if acquired:
+      self.writer = get_ident()
+      self.depth += 1
+    return acquired
+    
+  def release(self):
+    if self.writer != get_ident():
+      raise RuntimeError('cannot release un-acquired lock')
+    self.depth -= 1
+    if self.depth == 0:
+      self.writer = None
+    self._lock.release()
+    
+  def __enter__(self):
+    self.acquire()
+    
+  def __exit__(self, *exc):
+    self.release()
+
+class ReadWriteLock():
+  """Lock that lets any number of threads read at the same time, while writers get exclusive access.
+  
+  `acquire` and `release` are the write side, and re-entrant like `WriteLock`. `acquire_read` and `release_read` are the read side. The thread holding the write lock can also read, and a reader that starts to write gives up its reads until it has finished writing. Waiting writers are preferred over new readers, so that a steady stream of reads does not starve the writers."""
+  
+  shared = True
+  
+  def __init__(self):
+    self._mutex = Lock()
+    self._condition = Condition(self._mutex)
+    self.writer = None
+    self.depth = 0
+    self.readers = {}
+    self.waiting_writers = 0
+    self._suspended_reads = 0
+    
+  def acquire(self, blocking=True, timeout=-1):
+    me = get_ident()
+    with self._condition:
+      if self.writer == me:
+        self.depth += 1
+        return True
+      reads = self.readers.pop(me, 0)
+      if reads:
+        self._condition.notify_all()
+      self.waiting_writers += 1
+      try:
+        acquired = self._condition.wait_for(
+          lambda: self.writer is None and not self.readers,
+          None if blocking and timeout < 0 else timeout if blocking else 0)
+      finally:
+        self.waiting_writers -= 1
+      if not acquired:
+        if reads:
+          self._condition.wait_for(lambda: self.writer is None)
+          self.readers[me] = reads
+        return False
+      self.writer = me
+      self.depth = 1
+      self._suspended_reads = reads
+      return True
+      
+  def release(self):
+    with self._condition:
+      if self.writer != get_ident():
+        raise RuntimeError('cannot release un-acquired lock')
+      self.depth -= 1
+      if self.depth == 0:
+        self.writer = None
+        if self._suspended_reads:
+          self.readers[get_ident()] = self._suspended_reads
+          self._suspended_reads = 0
+        self._condition.notify_all()
+        
+  def __enter__(self):
+    self.acquire()
+    
+  def __exit__(self, *exc):
+    self.release()
+    
+  def acquire_read(self):
+    me = get_ident()
+    readers = self.readers
+    with self._mutex:
+      if (self.writer is not None or self.waiting_writers) and (
+          self.writer != me and me not in readers):
+        self._condition.wait_for(
+          lambda: self.writer is None and not self.waiting_writers)
+      readers[me] = readers.get(me, 0) + 1
+      
+  def release_read(self):
+    me = get_ident()
+    readers = self.readers
+    with self._mutex:
+      reads = readers.get(me)
+      if not reads:
+        raise RuntimeError('cannot release un-acquired lock')
+      if reads == 1:
+        del readers[me]
+        if self.waiting_writers:
+          self._condition.notify_all()
+      else:
+        readers[me] = reads - 1
+
+def estimate_size(obj):
+  """Estimates the memory used by obj and the dicts, lists, sets, tuples and objects it contains, counting each object once. Tracked containers are measured by their contents."""
+  seen = set()
+  size = 0
+  stack = [obj]
+  while stack:
+    obj = stack.pop()
+    obj = getattr(obj, '__subject__', obj)
+    if id(obj) in seen or isinstance(
+        obj, (type, FunctionType, MethodType, ModuleType)):
+      continue
+    seen.add(id(obj))
+    size += getsizeof(obj)
+    if isinstance(obj, dict):
+      stack.extend(obj.keys())
+      stack.extend(obj.values())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+      stack.extend(obj)
+    elif hasattr(obj, '__dict__'):
+      stack.append(obj.__dict__)
+  return size
+
 class LazyLoadMarker():
-  """Marker object indicating content that has not been loaded yet. DictWrapper __getitem__ method loads the content when this object is encountered."""
+  """Marker object indicating content that has not been loaded yet. Dict and list wrappers load the content when this object is encountered on a read, if the persistence has `lazy_loading` set.
+  
+  `key` is the key the persistence loads the content with, if it is not the key the marker is found at."""
+  
+  __slots__ = ('key',)
+  
+  def __init__(self, key=None):
+    self.key = key
 
 if __name__ == '__main__':
   pass
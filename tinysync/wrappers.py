@@ -1,35 +1,163 @@
 #coding: utf-8
 
-from tinysync.proxies import ObjectWrapper
+from tinysync.proxies import DirectWrapper
 from collections.abc import MutableSequence, MutableMapping, MutableSet
+from collections.abc import ValuesView, ItemsView
 from types import SimpleNamespace
-import functools, copy
-
-import dictdiffer
+import functools, copy, io, pickle, dataclasses
+from threading import get_ident
 
 from tinysync.util import *
 
 def synchronized(func):
-    """ Decorator for making wrapper functions, i.e.
-    all access and updates, thread safe. """
+    """ Decorator for making wrapper read functions thread
+    safe. The lock is only taken if another thread is holding
+    it, i.e. is in the middle of changing the structure.
+
+    With a shared `ReadWriteLock`, the read side of the lock
+    is taken instead, so that writers wait for the readers. """
     @functools.wraps(func)
     def _wrapper(self, *args, **kwargs):
-        handler = self._tracker.handler
-        if handler.lock:
-            with self._tracker.handler.lock:
+        lock = self._tracker.handler.lock
+        if lock is not None and lock.shared:
+            lock.acquire_read()
+            try:
                 return func(self, *args, **kwargs)
-        else:
-            return func(self, *args, **kwargs)
+            finally:
+                lock.release_read()
+        writer = lock and lock.writer
+        if writer and writer != get_ident():
+            with lock:
+                return func(self, *args, **kwargs)
+        return func(self, *args, **kwargs)
     return _wrapper
 
-class TrackerWrapper(ObjectWrapper):
+def read_locked(lock, func, *args):
+    """ Calls `func` like `synchronized` does, for the read
+    methods that check the lock inline, so that reading
+    without a writer or a shared lock needs no extra call. """
+    if lock.shared:
+        lock.acquire_read()
+        try:
+            return func(*args)
+        finally:
+            lock.release_read()
+    if lock.writer != get_ident():
+        with lock:
+            return func(*args)
+    return func(*args)
+
+class Tracker:
+    """ Tracking information of a wrapper: the handler,
+    and the parent wrapper and key the wrapper is found
+    at.
+
+    Path is not stored but computed from the parent links
+    when needed. For values in lists, `key` is just a hint
+    that is checked and updated when the path is computed,
+    so that inserting to or removing from a list does not
+    require updating the following values.
+
+    `frozen` is the plain copy of the contents used in
+    snapshots, cleared when the contents change.
+
+    `shared` is set when the wrapper has been stored at a
+    second key while still found at the first one, so that
+    removing it from one key does not detach it.
+
+    There is one tracker per tracked container, so it is kept
+    to a minimal slotted record. """
+
+    __slots__ = ('handler', 'parent', 'key', 'frozen', 'shared')
+
+    def __init__(self, handler, parent, key):
+        self.handler = handler
+        self.parent = parent
+        self.key = key
+        self.frozen = None
+        self.shared = False
+
+    @property
+    def path(self):
+        keys = []
+        tracker = self
+        while tracker.parent is not None:
+            keys.append(tracker.resolve_key())
+            tracker = tracker.parent._tracker
+        keys.reverse()
+        return tracker.handler.path_prefix + keys
+
+    def resolve_key(self):
+        parent_subject = self.parent.__subject__
+        if isinstance(parent_subject, MutableSequence):
+            key = self.key
+            if not (0 <= key < len(parent_subject)
+                    and self.tracks(parent_subject[key])):
+                for index, value in enumerate(parent_subject):
+                    if self.tracks(value):
+                        self.key = index
+                        break
+        return self.key
+
+    def tracks(self, value):
+        return (
+            issubclass(type(value), TrackerWrapper)
+            and value._tracker is self
+        )
+
+
+class DetachedHandler:
+    """ Stands in for the handler in subtrees that have been
+    removed from the tracked structure. Detached wrappers
+    can still be read and changed like the wrapped objects,
+    but the changes are not tracked, and the subtrees do not
+    keep the handler or the rest of the structure alive. """
+
+    lock = None
+    lazy = False
+    lazy_loading = False
+    journaling = False
+    resident = None
+    path_prefix = []
+
+    def child(self, node, key, value):
+        return value
+
+    def __repr__(self):
+        return '<detached>'
+
+detached = DetachedHandler()
+
 
-    _tracker = None
+class TrackerWrapper(DirectWrapper):
 
-    def __init__(self, obj, path, handler):
-        ObjectWrapper.__init__(self, obj)
+    __slots__ = ('_tracker', '__weakref__')
 
-        object.__setattr__(self, '_tracker', SimpleNamespace(handler=handler, path=path))
+    def __init__(self, obj, handler, parent=None, key=None):
+        DirectWrapper.__init__(self, obj)
+
+        object.__setattr__(self, '_tracker', Tracker(handler, parent, key))
+
+    # Most frequent reads check the lock inline, see
+    # `read_locked`.
+
+    def __len__(self):
+        lock = self._tracker.handler.lock
+        if lock is not None and (lock.shared or lock.writer):
+            return read_locked(lock, len, self.__subject__)
+        return len(self.__subject__)
+
+    def __contains__(self, value):
+        lock = self._tracker.handler.lock
+        if lock is not None and (lock.shared or lock.writer):
+            return read_locked(lock, self.__subject__.__contains__, value)
+        return value in self.__subject__
+
+    def __iter__(self):
+        lock = self._tracker.handler.lock
+        if lock is not None and (lock.shared or lock.writer):
+            return read_locked(lock, iter, self.__subject__)
+        return iter(self.__subject__)
 
     def __deepcopy__(self, memo):
         return copy.deepcopy(self.__subject__, memo)
@@ -61,13 +189,111 @@ class TrackerWrapper(ObjectWrapper):
         handler = self._tracker.handler
         if handler.lock:
             handler.lock.release()
+            if (
+                handler.coalesce == 'batch'
+                and handler.lock.writer != get_ident()
+            ):
+                handler.flush()
 
     def __repr__(self):
         return self.__subject__.__repr__()
 
 
 class DictWrapper(TrackerWrapper):
-    pass
+
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        lock = self._tracker.handler.lock
+        if lock is not None and (lock.shared or lock.writer):
+            return read_locked(lock, self.__subject__.__getitem__, key)
+        return self.__subject__[key]
+
+    @synchronized
+    def get(self, key, default=None):
+        return self.__subject__.get(key, default)
+
+    @synchronized
+    def values(self):
+        return self.__subject__.values()
+
+    @synchronized
+    def items(self):
+        return self.__subject__.items()
+
+
+class LazyDictWrapper(DictWrapper):
+    """ Dict wrapper used by lazy handlers, see
+    `lazy_wrapper_for`. Values are wrapped, or loaded,
+    when they are read. """
+
+    __slots__ = ()
+
+    @synchronized
+    def __getitem__(self, key):
+        return self._tracker.handler.child(
+            self, key, self.__subject__[key])
+
+    @synchronized
+    def get(self, key, default=None):
+        if key in self.__subject__:
+            return self[key]
+        return default
+
+    # With a limit on resident values, values are
+    # read through views of the wrapper, as reading
+    # all of them at once could evict the first ones.
+
+    @synchronized
+    def values(self):
+        if self._tracker.handler.resident is not None:
+            return ValuesView(self)
+        self._read_all()
+        return self.__subject__.values()
+
+    @synchronized
+    def items(self):
+        if self._tracker.handler.resident is not None:
+            return ItemsView(self)
+        self._read_all()
+        return self.__subject__.items()
+
+    # With lazy loading, the reads below go through the
+    # loaded values, as values loaded earlier can be
+    # evicted back to markers while reading the rest.
+
+    @synchronized
+    def __eq__(self, other):
+        if self._tracker.handler.lazy_loading:
+            return self.copy() == other
+        return self.__subject__ == other
+
+    @synchronized
+    def __ne__(self, other):
+        return not self == other
+
+    @synchronized
+    def copy(self):
+        if self._tracker.handler.lazy_loading:
+            return dict(self.items())
+        return self.__subject__.copy()
+
+    def __repr__(self):
+        if self._tracker.handler.lazy_loading:
+            return repr(self.copy())
+        return self.__subject__.__repr__()
+
+    def __str__(self):
+        return self.__repr__()
+
+    def __deepcopy__(self, memo):
+        if self._tracker.handler.lazy_loading:
+            return copy.deepcopy(self.copy(), memo)
+        return copy.deepcopy(self.__subject__, memo)
+
+    def _read_all(self):
+        for key in list(self.__subject__):
+            self[key]
 
 
 class DictWrapper_Dot(DictWrapper):
@@ -89,13 +315,7 @@ class DictWrapper_Dot(DictWrapper):
     >>> del dct.b
     """
 
-    @synchronized
-    def __getitem__(self, key):
-        value = self.__subject__[key]
-        if isinstance(value, LazyLoadMarker):
-            value = self._tracker.handler.load(key, self._tracker.path)
-            self.__subject__[key] = value
-        return value
+    __slots__ = ()
 
     @synchronized
     def __getattr__(self, key):
@@ -123,10 +343,82 @@ class DictWrapper_Dot(DictWrapper):
         raise AttributeError("'%s' object has no attribute '%s'" % (type(self).__name__, key))
 
 
-class ListWrapper(TrackerWrapper): pass
+class LazyDictWrapper_Dot(DictWrapper_Dot, LazyDictWrapper):
+
+    __slots__ = ()
+
+
+class ListWrapper(TrackerWrapper):
+
+    __slots__ = ()
+
+    def __getitem__(self, index):
+        lock = self._tracker.handler.lock
+        if lock is not None and (lock.shared or lock.writer):
+            return read_locked(lock, self.__subject__.__getitem__, index)
+        return self.__subject__[index]
+
+
+class LazyListWrapper(ListWrapper):
+    """ List wrapper used by lazy handlers, see
+    `lazy_wrapper_for`. Values are wrapped, or loaded,
+    when they are read. """
+
+    __slots__ = ()
+
+    @synchronized
+    def __getitem__(self, index):
+        subject = self.__subject__
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(subject)))]
+        value = subject[index]
+        if index < 0:
+            index += len(subject)
+        return self._tracker.handler.child(self, index, value)
+
+    @synchronized
+    def __iter__(self):
+        return (self[i] for i in range(len(self.__subject__)))
+
+    @synchronized
+    def __contains__(self, value):
+        if not self._tracker.handler.lazy_loading:
+            return value in self.__subject__
+        return any(item is value or item == value for item in self)
+
+    @synchronized
+    def __eq__(self, other):
+        if self._tracker.handler.lazy_loading:
+            return self.copy() == other
+        return self.__subject__ == other
+
+    @synchronized
+    def __ne__(self, other):
+        return not self == other
+
+    @synchronized
+    def copy(self):
+        if self._tracker.handler.lazy_loading:
+            return list(self)
+        return self.__subject__.copy()
+
+    def __repr__(self):
+        if self._tracker.handler.lazy_loading:
+            return repr(self.copy())
+        return self.__subject__.__repr__()
+
+    def __str__(self):
+        return self.__repr__()
+
+    def __deepcopy__(self, memo):
+        if self._tracker.handler.lazy_loading:
+            return copy.deepcopy(self.copy(), memo)
+        return copy.deepcopy(self.__subject__, memo)
 
 
-class SetWrapper(TrackerWrapper): pass
+class SetWrapper(TrackerWrapper):
+
+    __slots__ = ()
 
 
 class CustomWrapper(TrackerWrapper):
@@ -141,22 +433,650 @@ class CustomWrapper(TrackerWrapper):
     'new value'
     """
 
-trackable_types = {
+    __slots__ = ()
+
+    @synchronized
+    def __getattr__(self, attr):
+        subject = self.__subject__
+        value = getattr(subject, attr)
+        if attr in subject.__dict__:
+            value = self._tracker.handler.child(self, attr, value)
+        return value
+
+
+@functools.lru_cache(maxsize=None)
+def object_fields(cls):
+    """ Returns the names of the fields of a dataclass, or
+    of the slots of a class, when its instances have no
+    __dict__. Returns None for other classes, which are
+    tracked through their __dict__. Computed once per
+    class. """
+    if cls.__dictoffset__ != 0:
+        return None
+    if dataclasses.is_dataclass(cls):
+        return tuple(field.name for field in dataclasses.fields(cls))
+    names = []
+    for klass in reversed(cls.__mro__):
+        slots = klass.__dict__.get('__slots__', ())
+        if isinstance(slots, str):
+            slots = (slots,)
+        names.extend(
+            name for name in slots
+            if name not in ('__dict__', '__weakref__')
+            and name not in names
+        )
+    return tuple(names) or None
+
+class FieldsWrapper(TrackerWrapper):
+    """ Tracks attribute changes of slotted dataclasses,
+    and of classes with __slots__ registered in the
+    trackable types. Fields are looked up from the class,
+    as the objects have no __dict__. Objects with a
+    __dict__ are tracked with CustomWrapper.
+
+    >>> @dataclasses.dataclass(slots=True)
+    ... class Point:
+    ...   x: int
+    ...   y: list
+    >>> tracked_point = track(Point(1, [2]),
+    ...   callback=catcher.cb)
+    >>> tracked_point.x = 'new value'
+    >>> catcher.target.x
+    'new value'
+    """
+
+    __slots__ = ()
+
+    @synchronized
+    def __getattr__(self, attr):
+        subject = self.__subject__
+        value = getattr(subject, attr)
+        if attr in object_fields(type(subject)):
+            value = self._tracker.handler.child(self, attr, value)
+        return value
+
+class TrackableTypes(dict):
+    """ Mapping from types, typically abstract base
+    classes, to the wrapper classes used to track their
+    instances. Later entries take precedence over earlier
+    ones, so concrete types can be registered to override
+    the defaults.
+
+    Wrapper class resolved for each concrete type is
+    cached. Cache is cleared whenever the mapping is
+    changed. """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.resolved = {}
+
+    def wrapper_for(self, value):
+        """ Returns the wrapper class used to track the
+        value, or None if the value is not trackable. """
+        value_type = type(value)
+        try:
+            return self.resolved[value_type]
+        except KeyError:
+            pass
+        wrapper_class = None
+        if not issubclass(value_type, (TrackerWrapper, LazyLoadMarker)):
+            for trackable_type, candidate in self.items():
+                if issubclass(value_type, trackable_type):
+                    wrapper_class = candidate
+            if wrapper_class is None:
+                if hasattr(value, '__dict__'):
+                    wrapper_class = CustomWrapper
+                elif dataclasses.is_dataclass(value_type):
+                    wrapper_class = FieldsWrapper
+        self.resolved[value_type] = wrapper_class
+        return wrapper_class
+
+    def copy(self):
+        return TrackableTypes(self)
+
+def _clearing_cache(func_name):
+    def func(self, *args, **kwargs):
+        self.resolved.clear()
+        return getattr(dict, func_name)(self, *args, **kwargs)
+    func.__name__ = func_name
+    return func
+
+for func_name in ('__setitem__', '__delitem__', 'pop', 'popitem',
+        'clear', 'update', 'setdefault', '__ior__'):
+    setattr(TrackableTypes, func_name, _clearing_cache(func_name))
+
+# Variants of the wrapper classes used by lazy
+# handlers, so that the default read methods do
+# not need to check for lazy mode.
+lazy_wrappers = {
+  DictWrapper: LazyDictWrapper,
+  DictWrapper_Dot: LazyDictWrapper_Dot,
+  ListWrapper: LazyListWrapper,
+}
+
+def lazy_wrapper_for(wrapper_class):
+    """ Returns the variant of the wrapper class used by
+    lazy handlers. For other subclasses of the dict and list
+    wrappers, the variant is created on first use. """
+    try:
+        return lazy_wrappers[wrapper_class]
+    except KeyError:
+        pass
+    lazy_class = wrapper_class
+    for plain, lazy in (
+        (DictWrapper, LazyDictWrapper),
+        (ListWrapper, LazyListWrapper),
+    ):
+        if issubclass(wrapper_class, plain) and not issubclass(
+                wrapper_class, lazy):
+            lazy_class = type('Lazy' + wrapper_class.__name__,
+                (wrapper_class, lazy), {'__slots__': ()})
+    lazy_wrappers[wrapper_class] = lazy_class
+    return lazy_class
+
+def set_class(wrapper, wrapper_class):
+    """ Changes the class of a wrapper, e.g. to the lazy variant
+    when it is attached to a lazy handler. `__class__` of the
+    wrapper reports the class of the subject, so the slot of
+    `object` is used directly. """
+    object.__dict__['__class__'].__set__(wrapper, wrapper_class)
+
+# Types whose values are always read with item
+# access when resolving paths.
+item_access_types = frozenset((
+  dict, list, DictWrapper, DictWrapper_Dot, ListWrapper,
+  LazyDictWrapper, LazyDictWrapper_Dot, LazyListWrapper))
+
+trackable_types = TrackableTypes({
   MutableSequence: ListWrapper,
   MutableMapping: DictWrapper,
   MutableSet: SetWrapper
-}
+})
+
+# Functions returning the region of the
+# subject that a mutating call is about to
+# change, given the subject and the call
+# arguments:
+#
+# * For lists, a slice of the list.
+# * For other types, a list of keys.
+# * None means that the change can affect all
+#   of the contents.
+# * RETURNED means that the removed key is only
+#   known from the return value of the call.
+#
+# Only the values in the changed region need
+# to be checked for tracking, and recorded for
+# undo.
+
+RETURNED = SimpleNamespace()
+
+def _first_arg(subject, args, kwargs):
+    return args[:1]
+
+def _set_arg(subject, args, kwargs):
+    return list(args[0]) if args else []
+
+def _all(subject, args, kwargs):
+    return None
+
+def _returned(subject, args, kwargs):
+    return RETURNED
+
+def _dict_update(subject, args, kwargs):
+    if args and not hasattr(args[0], 'keys'):
+        return None
+    return list(args[0].keys() if args else ()) + list(kwargs)
+
+def _list_index(subject, args, kwargs):
+    index = args[0] if args else -1
+    length = len(subject)
+    if isinstance(index, slice):
+        start, stop, step = index.indices(length)
+        if step < 0:
+            start, stop = stop + 1, start + 1
+        return slice(start, max(start, stop))
+    if index < 0:
+        index += length
+    return slice(index, index + 1)
+
+def _list_insert(subject, args, kwargs):
+    index, length = args[0], len(subject)
+    if index < 0:
+        index += length
+    index = min(max(index, 0), length)
+    return slice(index, index)
+
+def _list_end(subject, args, kwargs):
+    return slice(len(subject), len(subject))
+
+def _list_remove(subject, args, kwargs):
+    index = subject.index(args[0])
+    return slice(index, index + 1)
+
+def _list_all(subject, args, kwargs):
+    return slice(0, len(subject))
+
+def _load_region(wrapper, region):
+    """ Loads the lazily loaded values in the region of
+    the wrapper, and the values contained in them, before
+    a call that returns them. Values removed from the
+    structure can no longer be loaded. """
+    subject = wrapper.__subject__
+    if region is RETURNED:
+        if not isinstance(subject, MutableMapping) or not subject:
+            return
+        region = [next(reversed(subject))]
+    if isinstance(region, slice):
+        region = range(region.start, min(region.stop, len(subject)))
+    stack = [
+        wrapper[key] for key in region
+        if isinstance(subject, MutableSequence) or key in subject
+    ]
+    while stack:
+        value = stack.pop()
+        if issubclass(type(value), DictWrapper):
+            stack.extend(value[key] for key in list(value.__subject__))
+        elif issubclass(type(value), ListWrapper):
+            stack.extend(value)
+
+# Mutating methods that return values from the
+# contents, loaded first if not loaded yet.
+value_returning_methods = frozenset(('pop', 'popitem', 'setdefault'))
+
+def touched_keys(subject, region, length):
+    """ Returns the keys that need to be checked for
+    tracking and path updates after a change to the given
+    region, or None if all of the contents need to be checked.
+    `length` is the length of the subject before the change. """
+    if region is RETURNED:
+        return ()
+    if isinstance(region, slice):
+        return range(region.start,
+            region.stop + len(subject) - length)
+    return region
+
+def tracked_values(subject, region):
+    """ Returns the tracked values in the region of the
+    subject, i.e. the values that a change to the region
+    may replace or remove. """
+    if region is RETURNED or isinstance(subject, MutableSet):
+        return []
+    if isinstance(region, slice):
+        values = subject[region]
+    elif region is None:
+        values = list(subject.values())
+    elif isinstance(subject, MutableMapping):
+        values = [subject.get(key) for key in region]
+    else:
+        values = [getattr(subject, key, None) for key in region]
+    return [
+        value for value in values
+        if issubclass(type(value), TrackerWrapper)
+    ]
+
+def moves_keys(subject, region, length, replaced):
+    """ True if a change to the region removed or moved tracked
+    values, i.e. replaced some, or changed the length of a list,
+    which moves the values at negative indexes. """
+    return bool(replaced) or (
+        isinstance(region, slice) and len(subject) != length)
 
 mutating_methods = {
-  CustomWrapper: [ '__setattr__'],
-  DictWrapper:
-    ['__setitem__', '__delitem__', 'pop', 'popitem', 'clear', 'update', 'setdefault'],
-  ListWrapper:
-    ['__setitem__', '__delitem__', 'insert', 'append', 'reverse', 'extend', 'pop', 'remove', 'clear', '__iadd__'],
-  SetWrapper:
-    ['add', 'discard', 'clear', 'pop', 'remove', '__ior__', '__iand__', '__ixor__', '__isub__']
+  CustomWrapper: {
+    '__setattr__': _first_arg,
+    '__delattr__': _first_arg,
+  },
+  FieldsWrapper: {
+    '__setattr__': _first_arg,
+    '__delattr__': _first_arg,
+  },
+  DictWrapper: {
+    '__setitem__': _first_arg,
+    '__delitem__': _first_arg,
+    'pop': _first_arg,
+    'popitem': _returned,
+    'clear': _all,
+    'update': _dict_update,
+    'setdefault': _first_arg,
+  },
+  ListWrapper: {
+    '__setitem__': _list_index,
+    '__delitem__': _list_index,
+    'insert': _list_insert,
+    'append': _list_end,
+    'reverse': _list_all,
+    'extend': _list_end,
+    'pop': _list_index,
+    'remove': _list_remove,
+    'clear': _list_all,
+    '__iadd__': _list_end,
+  },
+  SetWrapper: {
+    'add': _first_arg,
+    'discard': _first_arg,
+    'clear': _all,
+    'pop': _returned,
+    'remove': _first_arg,
+    '__ior__': _set_arg,
+    '__iand__': _all,
+    '__ixor__': _set_arg,
+    '__isub__': _set_arg,
+  },
+}
+
+# Bulk operations, added to the wrappers in
+# addition to the mutating methods of the
+# wrapped types. Each is one change: the new
+# values are checked for tracking in one pass,
+# and there is one change notification, sync
+# and save for the whole operation.
+#
+# * `bulk_extend(values)` adds the values to
+#   the end of a list.
+# * `bulk_update(values)` adds or updates dict
+#   items, or adds set members.
+# * `bulk_delete(keys)` removes a collection of
+#   keys from a dict, indexes from a list, or
+#   members from a set.
+#
+# Table values are the function normalizing
+# the call arguments, the region function and
+# the function applying the operation to the
+# wrapped object. Arguments are normalized
+# first, so that iterators are only consumed
+# once, and the region lists the actual keys.
+# Calls with nothing to change return right
+# away, without a change notification.
+
+def _as_list(args, kwargs):
+    return (list(args[0]),), kwargs
+
+def _as_dict(args, kwargs):
+    return (dict(*args, **kwargs),), {}
+
+def _keys_arg(subject, args, kwargs):
+    return list(args[0])
+
+def _list_indexes(subject, args, kwargs):
+    length = len(subject)
+    indexes = [
+        index + length if index < 0 else index for index in args[0]]
+    return slice(min(indexes, default=length), length)
+
+def _delete_keys(subject, keys):
+    keys = list(dict.fromkeys(keys))
+    for key in keys:
+        if key not in subject:
+            raise KeyError(key)
+    for key in keys:
+        del subject[key]
+
+def _delete_indexes(subject, indexes):
+    length = len(subject)
+    indexes = sorted({
+        index + length if index < 0 else index for index in indexes
+    }, reverse=True)
+    if indexes and (indexes[0] >= length or indexes[-1] < 0):
+        raise IndexError('list index out of range')
+    for index in indexes:
+        del subject[index]
+
+bulk_methods = {
+  DictWrapper: {
+    'bulk_update': (_as_dict, _dict_update, lambda subject, values:
+        subject.update(values)),
+    'bulk_delete': (_as_list, _keys_arg, _delete_keys),
+  },
+  ListWrapper: {
+    'bulk_extend': (_as_list, _list_end, lambda subject, values:
+        subject.extend(values)),
+    'bulk_delete': (_as_list, _list_indexes, _delete_indexes),
+  },
+  SetWrapper: {
+    'bulk_update': (_as_list, _set_arg, lambda subject, values:
+        subject.update(values)),
+    'bulk_delete': (_as_list, _set_arg, lambda subject, values:
+        subject.difference_update(values)),
+  },
 }
 
+
+_missing = SimpleNamespace()
+
+class Change:
+    """ Lightweight record of a single call to a mutating
+    method of a tracked object. Emitted for every change,
+    and refers to the target, the call arguments and the
+    new value without copying anything.
+
+    * `func_name`, `args` and `kwargs` describe the call.
+    * `path` is the path of the changed object at the
+      time of the change.
+    * `key` is the changed key, or for lists the index
+      where the change starts. None if the change covers
+      several keys or all the contents.
+    * `value` is the value at `key` after the change, or
+      None if the key was removed or there is no single key.
+    """
+
+    __slots__ = ('target', 'func_name', 'args', 'kwargs',
+        'region', 'length', 'key', 'value', 'path')
+
+    def __init__(self, target, func_name, args, kwargs, region, length):
+        self.target = target
+        self.func_name = func_name
+        self.args = args
+        self.kwargs = kwargs
+        self.region = region
+        self.length = length
+        self.key = None
+        self.value = None
+        self.path = target._tracker.path
+
+    @property
+    def keys(self):
+        """ The changed keys, or None if the change can affect
+        all of the contents. Always None for lists, where changes
+        can shift the following values to new indexes. """
+        region = self.region
+        if region is None or isinstance(region, slice):
+            return None
+        return region
+
+    def finish(self, return_value):
+        """ Records the changed key and the value after the call. """
+        subject = self.target.__subject__
+        region = self.region
+        if region is RETURNED:
+            region = self.region = [return_value[0] if isinstance(
+                subject, MutableMapping) else return_value]
+        if isinstance(region, slice):
+            self.key = region.start
+            if region.stop + len(subject) - self.length > region.start:
+                self.value = subject[region.start]
+        elif region is not None and len(region) == 1:
+            self.key = key = region[0]
+            if isinstance(subject, MutableSet):
+                self.value = key if key in subject else None
+            elif isinstance(subject, MutableMapping):
+                self.value = subject.get(key)
+            else:
+                self.value = getattr(subject, key, None)
+
+    def __repr__(self):
+        return '<%s %s at %s>' % (
+            type(self).__name__, self.func_name, self.path)
+
+
+class Operation(Change):
+    """ Change record that also holds the contents of the
+    changed region before and after the call, so that the
+    change can be undone and redone.
+
+    Size of the record is proportional to the size of the
+    change, not to the size of the changed object.
+
+    `location` is the path of the target at the time of the
+    change, used to find the target when the operation has
+    been restored from its serialized form. """
+
+    __slots__ = ('old', 'new', 'location')
+
+    def __init__(self, target, func_name, args, kwargs, region, length):
+        super().__init__(target, func_name, args, kwargs, region, length)
+        self.old = self.read(target.__subject__, region)
+        self.new = None
+
+    def finish(self, return_value):
+        """ Records the contents of the changed region
+        after the call. """
+        subject = self.target.__subject__
+        if self.region is RETURNED:
+            key = return_value[0] if isinstance(
+                subject, MutableMapping) else return_value
+            self.old = {key: return_value[1] if isinstance(
+                subject, MutableMapping) else True}
+        super().finish(return_value)
+        if isinstance(self.region, slice):
+            self.region = slice(self.region.start,
+                self.region.stop + len(subject) - self.length)
+        self.new = self.read(subject, self.region)
+        self.location = self.path
+
+    def undo(self, handler=None):
+        self.apply(self.old, self.new, handler)
+
+    def redo(self, handler=None):
+        self.apply(self.new, self.old, handler)
+
+    def apply(self, values, current, handler=None):
+        """ Writes `values` over the `current` contents of the
+        changed region. If `handler` is given, the target is looked
+        up by `location` in the structure of the handler instead of
+        using the target object recorded at the time of the change. """
+        target = self.target
+        if handler is not None:
+            target = handler.at(self.location[len(handler.path_prefix):])
+        target_handler = target._tracker.handler
+        subject = target.__subject__
+        length = len(subject) if hasattr(subject, '__len__') else 0
+        region = self.region
+        if isinstance(region, slice):
+            region = slice(region.start, region.start + len(current))
+        if target_handler is detached:
+            self.write(subject, values, current)
+            return
+        replaced = tracked_values(subject, region)
+        self.write(subject, values, current)
+        keys = touched_keys(subject, region, length)
+        if replaced:
+            target_handler.detach_removed(target, replaced, keys)
+        target_handler.make_updates(target, keys,
+            forget=moves_keys(subject, region, length, replaced))
+        if target_handler.journaling:
+            target_handler.log_write(
+                self, values, current, target._tracker.path)
+
+    def written(self, values, current, location):
+        """ Returns a copy of the operation, without the target,
+        that records writing `values` over the `current` contents
+        of the region in the object at `location`. """
+        record = copy.copy(self)
+        record.old, record.new, record.location = current, values, location
+        record.path = location
+        return record
+
+    @staticmethod
+    def read(subject, keys):
+        if keys is RETURNED:
+            return {}
+        if isinstance(keys, slice):
+            return subject[keys]
+        if isinstance(subject, MutableSet):
+            if keys is None:
+                return set(subject)
+            return { key: key in subject for key in keys }
+        if isinstance(subject, MutableMapping):
+            if keys is None:
+                return dict(subject)
+            return { key: subject.get(key, _missing) for key in keys }
+        if object_fields(type(subject)) is not None:
+            return { key: getattr(subject, key, _missing) for key in keys }
+        return {
+            key: subject.__dict__.get(key, _missing)
+            for key in keys
+        }
+
+    def write(self, subject, values, current):
+        """ Writes `values` over the `current` contents of the
+        changed region of the subject, which can also be a plain
+        object. """
+        if isinstance(self.region, slice):
+            start = self.region.start
+            subject[start:start + len(current)] = values
+        elif self.region is None:
+            subject.clear()
+            subject.update(values)
+        elif isinstance(subject, MutableSet):
+            for key, present in values.items():
+                if present:
+                    subject.add(key)
+                else:
+                    subject.discard(key)
+        elif isinstance(subject, MutableMapping):
+            for key, value in values.items():
+                if value is _missing:
+                    subject.pop(key, None)
+                else:
+                    subject[key] = value
+        else:
+            for key, value in values.items():
+                if value is _missing:
+                    if hasattr(subject, key):
+                        delattr(subject, key)
+                else:
+                    setattr(subject, key, value)
+
+    def __getstate__(self):
+        """ Serialized operations do not include the target or
+        the call arguments, and values are stored as plain copies. """
+        return {
+            name: getattr(self, name) for name in (
+                'func_name', 'region', 'length', 'key', 'location',
+                'old', 'new')
+        }
+
+    def __setstate__(self, state):
+        self.target = self.args = self.kwargs = self.value = None
+        for name, value in state.items():
+            setattr(self, name, value)
+
+
+class _OperationPickler(pickle.Pickler):
+
+    def persistent_id(self, obj):
+        return 'missing' if obj is _missing else None
+
+
+class _OperationUnpickler(pickle.Unpickler):
+
+    def persistent_load(self, pid):
+        return _missing
+
+
+def dump_operations(operations):
+    """ Returns the operations serialized as bytes. """
+    stream = io.BytesIO()
+    _OperationPickler(stream, pickle.HIGHEST_PROTOCOL).dump(list(operations))
+    return stream.getvalue()
+
+def load_operations(data):
+    """ Returns the operations serialized with `dump_operations`.
+    Apply them with a handler, as they have no target objects. """
+    return _OperationUnpickler(io.BytesIO(data)).load()
+
+
 # Add tracking wrappers to all mutating 
 # functions.
 # Changes use the re-entrant lock of the
@@ -165,18 +1085,78 @@ mutating_methods = {
 # blocks like synchronization.
 
 for wrapper_type in mutating_methods:
-    for func_name in mutating_methods[wrapper_type]:
-        def func(self, *args, tracker_function_name=func_name, **kwargs):
+    methods = {
+        func_name: (None, region_of, None)
+        for func_name, region_of in mutating_methods[wrapper_type].items()
+    }
+    methods.update(bulk_methods.get(wrapper_type, {}))
+    for func_name, (prepare, region_of, call) in methods.items():
+        def func(self, *args,
+                tracker_function_name=func_name,
+                tracker_prepare=prepare,
+                tracker_region_of=region_of,
+                tracker_call=call,
+                **kwargs):
+            if tracker_prepare is not None:
+                args, kwargs = tracker_prepare(args, kwargs)
+                if not args[0]:
+                    return None
             handler = self._tracker.handler
-            if handler.history is not None:
-                version_before = copy.deepcopy(self)
+            if handler.resident is not None:
+                handler.reinstate(self)
+                handler = self._tracker.handler
+            if handler is detached:
+                if tracker_call is None:
+                    return getattr(self.__subject__, tracker_function_name)(*args, **kwargs)
+                return tracker_call(self.__subject__, *args, **kwargs)
             with handler.lock:
-                return_value = getattr(self.__subject__, tracker_function_name)(*args, **kwargs)
-                if handler.history is not None:
-                    change_diff = list(dictdiffer.diff(version_before, self, node=self._tracker.path))
-                else:
-                    change_diff = []
-            handler.on_change(self, change_diff)
+                subject = self.__subject__
+                length = len(subject) if hasattr(subject, '__len__') else 0
+                region = tracker_region_of(subject, args, kwargs)
+                if (
+                    handler.lazy_loading
+                    and tracker_function_name in value_returning_methods
+                ):
+                    _load_region(self, region)
+                journal = handler.journal
+                record = (
+                    Operation if handler.history is not None
+                    or journal is not None or handler.journaling else Change
+                )
+                change = record(self, tracker_function_name,
+                    args, kwargs, region, length)
+                replaced = tracked_values(subject, region)
+                # A call that fails partway is still journaled, so
+                # that atomic() rolls back what it did change
+                finished = False
+                try:
+                    if tracker_call is None:
+                        return_value = getattr(subject, tracker_function_name)(*args, **kwargs)
+                    else:
+                        return_value = tracker_call(subject, *args, **kwargs)
+                    if region is RETURNED and isinstance(subject, MutableMapping):
+                        replaced = tracked_values([return_value[1]], slice(0, 1))
+                    keys = touched_keys(subject, region, length)
+                    if replaced:
+                        handler.detach_removed(self, replaced, keys)
+                    handler.make_updates(self, keys,
+                        forget=moves_keys(subject, region, length, replaced))
+                    change.finish(return_value)
+                    finished = True
+                finally:
+                    if journal is not None and (
+                        finished or region is not RETURNED
+                    ):
+                        if not finished:
+                            change.finish(None)
+                        journal.append(change)
+                if region is RETURNED and handler.path_cache:
+                    handler.forget_paths(self, change.region)
+                if handler.journaling:
+                    handler.log_write(
+                        change, change.new, change.old, change.location)
+            if journal is None:
+                handler.on_change(self, [change])
             return return_value
         setattr(wrapper_type, func_name, func)
         getattr(wrapper_type, func_name).__name__ = func_name